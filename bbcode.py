@@ -1,6 +1,18 @@
+import argparse
+import bisect
+import functools
+import gc
+import hashlib
+import itertools
+import json
+import os
+import random
 import re
 import sys
-from collections import OrderedDict
+import threading
+import time
+import types
+from collections import OrderedDict, deque
 from collections.abc import Mapping, MutableMapping
 
 __version__ = "1.2.0"
@@ -11,11 +23,84 @@ __version_info__ = tuple(int(num) for num in __version__.split("."))
 # Changed to only support one level of parentheses, since it was failing
 # catastrophically on some URLs.
 # See http://www.regular-expressions.info/catastrophic.html
+# The body matches one character (or parenthesized group) at a time, rather than runs of
+# them, so that it can only backtrack once over each character.
+_url_body = r'(?:[^\s()<>]|\([^\s()<>]+\))+(?:\([^\s()<>]+\)|[^\s`!()\[\]{};:\'".,<>?])'
 _url_re = re.compile(
-    r"(?im)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)"
-    r'(?:[^\s()<>]+|\([^\s()<>]+\))+(?:\([^\s()<>]+\)|[^\s`!()\[\]{};:\'".,<>?]))'
+    r"(?im)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)%s)" % _url_body
 )
 
+# Pieces of _url_re used by _find_urls to find the same URLs in linear time. Schemes are
+# found by their first letter (checking for a word boundary before it), which is much
+# faster than trying the whole prefix at every position.
+_url_scheme_re = re.compile(
+    r"[hHwW](?<!\w.)(?:(?<=[hH])(?i:ttps?://)|(?<=[wW])(?i:ww\d{0,3}[.]))"
+)
+_url_tld_re = re.compile(r"(?i)[.][a-z]{2,4}/")
+_url_host_reversed_re = re.compile(r"(?i)[a-z0-9.\-]*")
+_url_body_re = re.compile(_url_body)
+_word_boundary_re = re.compile(r"\b")
+
+
+def _find_urls(text):
+    """
+    Yields the (start, end) positions of the URLs in text, exactly as _url_re.finditer
+    would find them, but in linear time. The regex tries its host name prefix (such as
+    "example.com/") at every word boundary of a run of host name characters, which
+    takes quadratic time on long runs such as "a.a.a.a..."; here the top-level domains
+    are found first, and the run before each one is scanned once.
+    """
+    # Every URL starts with a scheme or "www", or has a slash after its host name, so
+    # most text is skipped after these two searches.
+    scheme = _url_scheme_re.search(text)
+    host = None
+    if "/" in text:
+        reversed_text = text[::-1]
+        host = _find_url_host(text, reversed_text, 0)
+    pos = 0
+    while True:
+        if scheme is not None and scheme.start() < pos:
+            scheme = _url_scheme_re.search(text, pos)
+        if host is not None and host[0] < pos:
+            host = _find_url_host(text, reversed_text, pos)
+        if scheme is None and host is None:
+            return
+        if host is None or (scheme is not None and scheme.start() <= host[0]):
+            match = _url_body_re.match(text, scheme.end())
+            if match is None:
+                # Look for the next scheme, but a host name may still start here.
+                scheme = _url_scheme_re.search(text, scheme.start() + 1)
+                continue
+            start = scheme.start()
+        else:
+            match = _url_body_re.match(text, host[1])
+            if match is None:
+                # Every start in this run of host name characters fails the same way.
+                host = _find_url_host(text, reversed_text, host[1])
+                continue
+            start = host[0]
+        yield start, match.end()
+        pos = match.end()
+
+
+def _find_url_host(text, reversed_text, pos):
+    """
+    Finds the first position at or after pos where the host name prefix of _url_re
+    matches, returning (start, end) or None. Only one dot can start the top-level domain
+    before a given slash, so each one found is checked by scanning the run of host name
+    characters before it backwards (in reversed_text), which is done once per run.
+    """
+    length = len(text)
+    for tld in _url_tld_re.finditer(text, pos):
+        dot = tld.start()
+        run = _url_host_reversed_re.match(reversed_text, length - dot, length - pos)
+        start = dot - (run.end() - run.start())
+        boundary = _word_boundary_re.search(text, start, dot)
+        if boundary is not None and boundary.start() < dot:
+            return boundary.start(), tld.end()
+    return None
+
+
 # For the URL tag, try to be smart about when to append a missing http://. If the given
 # link looks like a domain, add a http:// in front of it, otherwise leave it alone
 # (since it may be a relative path, a filename, etc).
@@ -24,6 +109,146 @@ _domain_re = re.compile(
 )
 
 
+@functools.lru_cache(maxsize=32)
+def _tag_extent_re(opener, closer):
+    """
+    Compiles a pattern that scans from just after a tag opener to the end of the tag.
+    The scan stops (without consuming) at the next opener, or consumes the closer, in
+    which case the "close" group is set. Once an = sign has been seen, a quote character
+    starts a quoted section in which openers and closers are ignored. Every branch is
+    anchored on a distinct character, and the trailing group always matches, so the
+    pattern never backtracks and runs in linear time.
+    """
+    o = re.escape(opener)
+    c = re.escape(closer)
+    not_delim = "(?!%s|%s)" % (o, c)
+    # Runs of characters that cannot start a delimiter are matched in bulk, the rest one
+    # at a time after making sure no delimiter starts there.
+    first = set(opener[:1] + closer[:1])
+
+    def _chars(excluded, special):
+        return "|".join(
+            ["[^%s]+" % "".join(re.escape(ch) for ch in sorted(first | excluded))]
+            + [not_delim + re.escape(ch) for ch in sorted(first - special)]
+        )
+
+    unquoted = _chars({"="}, {"="})
+    quotable = _chars({'"', "'"}, {'"', "'"})
+    return re.compile(
+        # Characters outside of quotes, before any = sign (or after a closing quote).
+        "(?:%s" % unquoted
+        # An = sign, after which quote characters start a quoted section.
+        + "|%s=(?:%s)*" % (not_delim, quotable)
+        + "(?:\"[^\"]*(?:%s\")?|'[^']*(?:%s')?)?)*" % (not_delim, not_delim)
+        # Stop at an opener, consume a closer, or run off the end of the data.
+        + "(?:(?=%s)|(?P<close>%s))?" % (o, c)
+    )
+
+
+# Runs of characters with no special meaning in each state of _parse_tag_options.
+_option_name_run_re = re.compile(r"[^= ]+")
+_option_value_run_re = re.compile(r"[^\"' ]+")
+_option_quoted_run_re = {
+    '"': re.compile(r'[^"\\]+'),
+    "'": re.compile(r"[^'\\]+"),
+}
+
+
+def _parse_tag_options(data):
+    """
+    Parses the options out of a tag string for Parser._parse_opts, returning a tuple of
+    (tag_name, options). Runs of ordinary characters are consumed in bulk, and values
+    are built up as lists of pieces, so this runs in linear time.
+    """
+    name = None
+    opts = {}
+    in_value = False
+    in_quote = False
+    attr = ""
+    value = []
+    attr_done = False
+    stripped = data.strip()
+    ls = len(stripped)
+    # An unquoted value ends at a space, unless there is no = after it (in which case
+    # the value may accept spaces). Note this looks in the original (unstripped) data.
+    last_equals = data.rfind("=")
+    pos = 0
+
+    while pos < ls:
+        ch = stripped[pos]
+        if in_value:
+            if in_quote:
+                run = _option_quoted_run_re[in_quote].match(stripped, pos)
+                if run:
+                    value.append(run.group())
+                    pos = run.end()
+                    continue
+                if (
+                    ch == "\\"
+                    and ls > pos + 1
+                    and stripped[pos + 1] in ("\\", '"', "'")
+                ):
+                    value.append(stripped[pos + 1])
+                    pos += 1
+                elif ch == in_quote:
+                    in_quote = False
+                    in_value = False
+                    if attr:
+                        opts[attr.lower()] = (attr, "".join(value).strip())
+                    attr = ""
+                    value = []
+                else:
+                    value.append(ch)
+            else:
+                run = _option_value_run_re.match(stripped, pos)
+                if run:
+                    value.append(run.group())
+                    pos = run.end()
+                    continue
+                if ch != " ":
+                    in_quote = ch
+                elif last_equals > pos:
+                    opts[attr.lower()] = (attr, "".join(value).strip())
+                    attr = ""
+                    value = []
+                    in_value = False
+                else:
+                    value.append(ch)
+        else:
+            if ch == "=":
+                in_value = True
+                if name is None:
+                    name = attr
+            elif ch == " ":
+                attr_done = True
+            else:
+                if attr_done:
+                    if attr:
+                        if name is None:
+                            name = attr
+                        else:
+                            opts[attr.lower()] = (attr, "")
+                    attr = ""
+                    attr_done = False
+                run = _option_name_run_re.match(stripped, pos)
+                attr += run.group()
+                pos = run.end()
+                continue
+        pos += 1
+
+    if attr:
+        if name is None:
+            name = attr
+        opts[attr.lower()] = (attr, "".join(value).strip())
+    return name.lower(), FrozenCaseInsensitiveDict(opts.values())
+
+
+# Options parsed from short tag strings, such as [quote="name"] or [color=red], which
+# tend to be repeated. The options are immutable, so they can be shared.
+_parse_tag_options_memo = functools.lru_cache(maxsize=1024)(_parse_tag_options)
+_PARSE_OPTIONS_MEMO_MAX_LENGTH = 256
+
+
 # Taken from https://github.com/psf/requests/blob/eedd67462819f8dbf8c1c32e77f9070606605231/requests/structures.py#L15
 class CaseInsensitiveDict(MutableMapping):
     def __init__(self, data=None, **kwargs):
@@ -69,358 +294,1323 @@ class CaseInsensitiveDict(MutableMapping):
         return str(dict(self.items()))
 
 
-class TagOptions(object):
-    # The name of the tag, all lowercase.
-    tag_name = None
-
-    # True if a newline should automatically close this tag.
-    newline_closes = False
-
-    # True if another start of the same tag should automatically close this tag.
-    same_tag_closes = False
-
-    # True if this tag does not have a closing tag.
-    standalone = False
+class FrozenCaseInsensitiveDict(CaseInsensitiveDict):
+    """
+    A CaseInsensitiveDict that can't be changed once created, so that it can be shared.
+    Use copy() to get a CaseInsensitiveDict that can be changed.
+    """
 
-    # True if tags should be rendered inside this tag.
-    render_embedded = True
+    def __init__(self, data=None, **kwargs):
+        self._store = {}
+        for key, value in dict(data or {}, **kwargs).items():
+            self._store[key.lower()] = (key, value)
 
-    # True if newlines should be converted to markup.
-    transform_newlines = True
+    def __setitem__(self, key, value):
+        raise TypeError("%s does not support item assignment" % type(self).__name__)
 
-    # True if HTML characters (<, >, and &) should be escaped inside this tag.
-    escape_html = True
+    def __delitem__(self, key):
+        raise TypeError("%s does not support item deletion" % type(self).__name__)
+
+
+# The names of all the boolean TagOptions attributes.
+_TAG_OPTIONS = (
+    "newline_closes",
+    "same_tag_closes",
+    "standalone",
+    "render_embedded",
+    "transform_newlines",
+    "escape_html",
+    "replace_links",
+    "replace_cosmetic",
+    "strip",
+    "swallow_trailing_newline",
+)
 
-    # True if URLs should be replaced with link markup inside this tag.
-    replace_links = True
 
-    # True if cosmetic replacements (elipses, dashes, etc.) should be performed inside
-    # this tag.
-    replace_cosmetic = True
+class TagOptions(object):
+    """
+    The options a tag was registered with. Each boolean option is also kept as a bit
+    in flags (see the constants below), which is updated whenever an option is set, so
+    the formatter can check several options at once.
+    """
 
-    # True if leading and trailing whitespace should be stripped inside this tag.
-    strip = False
+    __slots__ = ("tag_name", "flags") + _TAG_OPTIONS
 
-    # True if this tag should swallow the first trailing newline (i.e. for block
-    # elements).
-    swallow_trailing_newline = False
+    NEWLINE_CLOSES = 1 << 0
+    SAME_TAG_CLOSES = 1 << 1
+    STANDALONE = 1 << 2
+    RENDER_EMBEDDED = 1 << 3
+    TRANSFORM_NEWLINES = 1 << 4
+    ESCAPE_HTML = 1 << 5
+    REPLACE_LINKS = 1 << 6
+    REPLACE_COSMETIC = 1 << 7
+    STRIP = 1 << 8
+    SWALLOW_TRAILING_NEWLINE = 1 << 9
 
     def __init__(self, tag_name, **kwargs):
+        # The name of the tag, all lowercase.
         self.tag_name = tag_name
+        self.flags = 0
+        # True if a newline should automatically close this tag.
+        self.newline_closes = False
+        # True if another start of the same tag should automatically close this tag.
+        self.same_tag_closes = False
+        # True if this tag does not have a closing tag.
+        self.standalone = False
+        # True if tags should be rendered inside this tag.
+        self.render_embedded = True
+        # True if newlines should be converted to markup.
+        self.transform_newlines = True
+        # True if HTML characters (<, >, and &) should be escaped inside this tag.
+        self.escape_html = True
+        # True if URLs should be replaced with link markup inside this tag.
+        self.replace_links = True
+        # True if cosmetic replacements (elipses, dashes, etc.) should be performed
+        # inside this tag.
+        self.replace_cosmetic = True
+        # True if leading and trailing whitespace should be stripped inside this tag.
+        self.strip = False
+        # True if this tag should swallow the first trailing newline (i.e. for block
+        # elements).
+        self.swallow_trailing_newline = False
         for attr, value in list(kwargs.items()):
             setattr(self, attr, bool(value))
 
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+        flag = _TAG_FLAGS.get(attr)
+        if flag is not None:
+            if value:
+                object.__setattr__(self, "flags", self.flags | flag)
+            else:
+                object.__setattr__(self, "flags", self.flags & ~flag)
 
-class Parser(object):
-    TOKEN_TAG_START = 1
-    TOKEN_TAG_END = 2
-    TOKEN_NEWLINE = 3
-    TOKEN_DATA = 4
+    def __getstate__(self):
+        # Classes with __slots__ need this to be pickled with protocols 0 and 1.
+        return {attr: getattr(self, attr) for attr in ("tag_name",) + _TAG_OPTIONS}
 
-    REPLACE_ESCAPE = (
-        ("&", "&amp;"),
-        ("<", "&lt;"),
-        (">", "&gt;"),
-        ('"', "&quot;"),
-        ("'", "&#39;"),
-    )
+    def __setstate__(self, state):
+        self.flags = 0
+        for attr, value in state.items():
+            setattr(self, attr, value)
 
-    REPLACE_COSMETIC = (
-        ("---", "&mdash;"),
-        ("--", "&ndash;"),
-        ("...", "&#8230;"),
-        ("(c)", "&copy;"),
-        ("(reg)", "&reg;"),
-        ("(tm)", "&trade;"),
+
+# The flags bit for each boolean TagOptions attribute.
+_TAG_FLAGS = {attr: getattr(TagOptions, attr.upper()) for attr in _TAG_OPTIONS}
+
+# The flags that select a Parser's ReplacementTable.
+_REPLACEMENT_FLAGS = (
+    TagOptions.ESCAPE_HTML | TagOptions.REPLACE_COSMETIC | TagOptions.TRANSFORM_NEWLINES
+)
+
+
+class _Unidentifiable(Exception):
+    """
+    Raised by _callable_name for a callable that can't be told apart from another one
+    of the same name.
+    """
+
+
+def _object_state(obj):
+    """
+    Returns a JSON string of the object if it is plain data (strings, numbers, and
+    lists, tuples or dicts of them), or otherwise of its attributes. Raises
+    _Unidentifiable if the attributes aren't plain data either.
+    """
+    state = obj
+    if not isinstance(obj, (str, int, float, bool, list, tuple, dict)):
+        state = dict(getattr(obj, "__dict__", {}))
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__", ())
+            for slot in (slots,) if isinstance(slots, str) else slots:
+                if slot not in ("__dict__", "__weakref__") and hasattr(obj, slot):
+                    state[slot] = getattr(obj, slot)
+    try:
+        return json.dumps(state, sort_keys=True)
+    except (TypeError, ValueError):
+        raise _Unidentifiable(obj)
+
+
+def _callable_name(func):
+    """
+    Returns a name for a render or linker function that is stable across processes,
+    including any string or number values the function closes over (such as the
+    format string of a simple formatter), and the attributes of a callable object (or
+    of the object a method is bound to). Raises _Unidentifiable if the attributes
+    aren't plain data.
+    """
+    if func is None:
+        return None
+    if isinstance(func, SimpleFormatter):
+        return ["SimpleFormatter", func.format_string]
+    if isinstance(func, functools.partial):
+        return [
+            "functools.partial",
+            _callable_name(func.func),
+            _object_state(func.args),
+            _object_state(func.keywords),
+        ]
+    if hasattr(func, "__qualname__"):
+        owner = getattr(func, "__self__", None)
+    else:
+        owner = func
+    name = "%s.%s" % (
+        getattr(func, "__module__", None),
+        getattr(func, "__qualname__", type(func).__qualname__),
     )
+    cells = getattr(func, "__closure__", None) or ()
+    values = [
+        cell.cell_contents
+        for cell in cells
+        if isinstance(cell.cell_contents, (str, int, float, bool))
+    ]
+    # The configuration of a parser whose methods render tags (such as
+    # Parser._render_url) is already part of its fingerprint.
+    if owner is not None and not isinstance(owner, (type, types.ModuleType, Parser)):
+        values.append(_object_state(owner))
+    return [name, values] if values else name
+
+
+def _overlaps(first, second):
+    """
+    Returns True if an occurrence of second in a text could share characters with an
+    occurrence of first.
+    """
+    for shift in range(1 - len(second), len(first)):
+        start = max(shift, 0)
+        end = min(shift + len(second), len(first))
+        if first[start:end] == second[start - shift : end - shift]:
+            return True
+    return False
 
-    def __init__(
-        self,
-        newline="<br />",
-        install_defaults=True,
-        escape_html=True,
-        replace_links=True,
-        replace_cosmetic=True,
-        tag_opener="[",
-        tag_closer="]",
-        linker=None,
-        linker_takes_context=False,
-        drop_unrecognized=False,
-        default_context=None,
-        max_tag_depth=None,
-        url_template='<a rel="nofollow" href="{href}">{text}</a>',
-    ):
-        self.tag_opener = tag_opener
-        self.tag_closer = tag_closer
-        self.newline = newline
-        self.recognized_tags = {}
-        self.drop_unrecognized = drop_unrecognized
-        self.escape_html = escape_html
-        self.replace_cosmetic = replace_cosmetic
-        self.replace_links = replace_links
-        self.linker = linker
-        self.linker_takes_context = linker_takes_context
-        self.max_tag_depth = max_tag_depth or sys.getrecursionlimit()
-        self.url_template = url_template
-        self.default_context = default_context or {}
-        if install_defaults:
-            self.install_default_formatters()
 
-    def add_formatter(self, tag_name, render_func, **kwargs):
-        """
-        Installs a render function for the specified tag name. The render function
-        should have the following signature:
+def _escape_independent(escapes, replacements):
+    """
+    Returns True if none of the replacements could match a character that escapes
+    replaces, or part of its escaped form, so that the replacements can be made in the
+    same pass as escaping with the same result as making them afterwards.
+    """
+    for find, repl in replacements:
+        for char, escaped in escapes:
+            if char in find or _overlaps(escaped, find):
+                return False
+    return True
 
-            def render(tag_name, value, options, parent, context)
 
-        The arguments are as follows:
+def _trie_pattern(node):
+    """
+    Returns a pattern matching the longest text in a trie of dicts keyed by character,
+    where an empty key marks the end of a text.
+    """
+    singles = []
+    branches = []
+    for ch in sorted(key for key in node if key):
+        child = node[ch]
+        if len(child) == 1 and "" in child:
+            singles.append(re.escape(ch))
+        else:
+            branches.append(re.escape(ch) + _trie_pattern(child))
+    if len(singles) > 1:
+        branches.append("[%s]" % "".join(singles))
+    else:
+        branches.extend(singles)
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+    # Try to match longer text first, then settle for the text ending here.
+    return "(?:%s)?" % pattern if "" in node else pattern
+
+
+class ReplacementTable(object):
+    """
+    A table of (find, repl) pairs, compiled into a trie-shaped pattern that makes all of
+    the replacements in a single pass. Where several entries could be found at the same
+    position, the longest one is replaced, and replaced text is never searched again.
+    If a find text is listed more than once, the first entry is used.
+    """
 
-            tag_name
-                The name of the tag being rendered.
-            value
-                The context between start and end tags, or None for standalone tags.
-                Whether this has been rendered depends on render_embedded tag option.
-            options
-                A dictionary of options specified on the opening tag.
-            parent
-                The parent TagOptions, if the tag is being rendered inside another tag,
-                otherwise None.
-            context
-                The keyword argument dictionary passed into the format call.
+    # Small tables are applied as a chain of str.replace calls instead, when that
+    # gives the same result.
+    CHAIN_MAX_ENTRIES = 16
+
+    def __init__(self, replacements=()):
+        self.replacements = {}
+        for find, repl in replacements:
+            if find:
+                self.replacements.setdefault(find, repl)
+        self._chain = self._compile_chain()
+        self._pattern = None
+        if self._chain is None:
+            trie = {}
+            for find in self.replacements:
+                node = trie
+                for ch in find:
+                    node = node.setdefault(ch, {})
+                node[""] = True
+            self._pattern = re.compile(_trie_pattern(trie))
+
+    def __repr__(self):
+        return "ReplacementTable(%r)" % list(self.replacements.items())
+
+    def __len__(self):
+        return len(self.replacements)
+
+    def __iter__(self):
+        return iter(self.replacements.items())
+
+    def _compile_chain(self):
         """
-        options = TagOptions(tag_name.strip().lower(), **kwargs)
-        self.recognized_tags[options.tag_name] = (render_func, options)
+        Returns the entries in an order that gives the same result when they are
+        replaced one after another, or None if there isn't one (or the table is large).
+        Entries must not overlap each other, except for runs of the same character
+        (like --- and --) with the longer run first, and an entry must come before any
+        entry whose replacement it could be found in.
+        """
+        if len(self.replacements) > self.CHAIN_MAX_ENTRIES:
+            return None
+        entries = sorted(self.replacements.items(), key=lambda e: -len(e[0]))
+        for num, (find, repl) in enumerate(entries):
+            for other in entries[num + 1 :]:
+                if _overlaps(find, other[0]) and len(set(find + other[0])) > 1:
+                    return None
+        chain = []
+        while entries:
+            for num, (find, repl) in enumerate(entries):
+                if not any(
+                    _overlaps(repl, other)
+                    or (len(other) > len(find) and _overlaps(other, find))
+                    for other, other_repl in entries
+                    if other != find
+                ):
+                    chain.append(entries.pop(num))
+                    break
+            else:
+                return None
+        return tuple(chain)
 
-    def add_simple_formatter(self, tag_name, format_string, **kwargs):
+    def replace(self, text):
         """
-        Installs a formatter that takes the tag options dictionary, puts a value key
-        in it, and uses it as a format dictionary to the given format string.
+        Returns the text with all replacements made.
         """
+        if self._chain is not None:
+            for find, repl in self._chain:
+                text = text.replace(find, repl)
+            return text
+        return self._pattern.sub(self._sub, text)
 
-        def _render(name, value, options, parent, context):
-            fmt = {}
-            if options:
-                fmt.update(options)
-            fmt.update({"value": value})
-            return format_string % fmt
+    def _sub(self, match):
+        return self.replacements[match.group()]
 
-        self.add_formatter(tag_name, _render, **kwargs)
 
-    def install_default_formatters(self):
-        """
-        Installs default formatters for the following tags:
+def _plain_data(value):
+    """
+    Returns whether the value is plain data: a str, int, float, bool or None, or a tuple
+    of them. Other objects may hash by identity, or have the same repr as an object
+    that renders differently, so they can't be part of a cache key.
+    """
+    if isinstance(value, tuple):
+        return all(_plain_data(item) for item in value)
+    return value is None or type(value) in (str, int, float, bool)
 
-            b, i, u, s, list (and *), quote, code, center, color, url
-        """
-        self.add_simple_formatter("b", "<strong>%(value)s</strong>")
-        self.add_simple_formatter("i", "<em>%(value)s</em>")
-        self.add_simple_formatter("u", "<u>%(value)s</u>")
-        self.add_simple_formatter("s", "<strike>%(value)s</strike>")
-        self.add_simple_formatter("hr", "<hr />", standalone=True)
-        self.add_simple_formatter("sub", "<sub>%(value)s</sub>")
-        self.add_simple_formatter("sup", "<sup>%(value)s</sup>")
 
-        def _render_list(name, value, options, parent, context):
-            list_type = options["list"] if (options and "list" in options) else "*"
-            css_opts = {
-                "1": "decimal",
-                "01": "decimal-leading-zero",
-                "a": "lower-alpha",
-                "A": "upper-alpha",
-                "i": "lower-roman",
-                "I": "upper-roman",
-            }
-            tag = "ol" if list_type in css_opts else "ul"
-            css = (
-                ' style="list-style-type:%s;"' % css_opts[list_type]
-                if list_type in css_opts
-                else ""
-            )
-            return "<%s%s>%s</%s>" % (tag, css, value, tag)
+class _ReplacementChain(object):
+    """
+    Applies ReplacementTables one after another, for replacements that must be made in
+    the text produced by earlier ones.
+    """
 
-        self.add_formatter(
-            "list",
-            _render_list,
-            transform_newlines=False,
-            strip=True,
-            swallow_trailing_newline=True,
-        )
+    __slots__ = ("tables",)
 
-        # Make sure transform_newlines = False for [*], so [code] tags can be embedded
-        # without transformation.
-        def _render_list_item(name, value, options, parent, context):
-            if not parent or parent.tag_name != "list":
-                return "[*]%s<br />" % value
+    def __init__(self, tables):
+        self.tables = tables
 
-            return "<li>%s</li>" % value
+    def replace(self, text):
+        for table in self.tables:
+            text = table.replace(text)
+        return text
 
-        self.add_formatter(
-            "*",
-            _render_list_item,
-            newline_closes=True,
-            transform_newlines=False,
-            same_tag_closes=True,
-            strip=True,
-        )
 
-        self.add_simple_formatter(
-            "quote",
-            "<blockquote>%(value)s</blockquote>",
-            strip=True,
-            swallow_trailing_newline=True,
-        )
-        self.add_simple_formatter(
-            "code",
-            "<code>%(value)s</code>",
-            render_embedded=False,
-            transform_newlines=False,
-            swallow_trailing_newline=True,
-            replace_cosmetic=False,
-        )
-        self.add_simple_formatter(
-            "center", '<div style="text-align:center;">%(value)s</div>'
-        )
+class RenderCache(object):
+    """
+    A thread-safe, in-memory LRU cache of rendered output, bounded by a number of
+    entries and (optionally) by the total size of the cached output, in characters.
+    """
 
-        def _render_color(name, value, options, parent, context):
-            if "color" in options:
-                color = options["color"].strip()
-            elif options:
-                color = list(options.keys())[0].strip()
-            else:
-                return value
-            match = re.match(r"^([a-z]+)|^(#[a-f0-9]{3,6})", color, re.I)
-            color = match.group() if match else "inherit"
-            return '<span style="color:%(color)s;">%(value)s</span>' % {
-                "color": color,
-                "value": value,
-            }
+    def __init__(self, max_entries=1024, max_size=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-        self.add_formatter("color", _render_color)
+    def __len__(self):
+        return len(self._entries)
 
-        def _render_url(name, value, options, parent, context):
-            if options and "url" in options:
-                # Option values are not escaped for HTML output.
-                href = self._replace(options["url"], self.REPLACE_ESCAPE)
-            else:
-                href = value
-            # Completely ignore javascript: and data: "links".
-            if re.sub(r"[^a-z0-9+]", "", href.lower().split(":", 1)[0]) in (
-                "javascript",
-                "data",
-                "vbscript",
-            ):
-                return ""
-            # Only add the missing http:// if it looks like it starts with a domain name.
-            if "://" not in href and _domain_re.match(href):
-                href = "http://" + href
-            return self.url_template.format(href=href.replace('"', "%22"), text=value)
+    def __getstate__(self):
+        # Locks can't be pickled, and there is no point in copying cached output.
+        return {"max_entries": self.max_entries, "max_size": self.max_size}
 
-        self.add_formatter(
-            "url", _render_url, replace_links=False, replace_cosmetic=False
-        )
+    def __setstate__(self, state):
+        self.__init__(**state)
 
-    def _replace(self, data, replacements):
+    def get(self, key):
         """
-        Given a list of 2-tuples (find, repl) this function performs all
-        replacements on the input and returns the result.
+        Returns the cached output for the given key, or None.
         """
-        for find, repl in replacements:
-            data = data.replace(find, repl)
-        return data
+        with self._lock:
+            try:
+                size, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Caches the output for the given key, evicting the least recently used entries
+        if the cache is full.
+        """
+        size = len(value)
+        if self.max_size is not None and size > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[0]
+            self._entries[key] = (size, value)
+            self.size += size
+            while len(self._entries) > self.max_entries or (
+                self.max_size is not None and self.size > self.max_size
+            ):
+                evicted_size, evicted = self._entries.popitem(last=False)[1]
+                self.size -= evicted_size
+                self.evictions += 1
 
-    def _newline_tokenize(self, data):
+    def clear(self):
         """
-        Given a string that does not contain any tags, this function will
-        return a list of NEWLINE and DATA tokens such that if you concatenate
-        their data, you will have the original string.
+        Removes all cached entries.
         """
-        parts = data.split("\n")
-        tokens = []
-        for num, part in enumerate(parts):
-            if part:
-                tokens.append((self.TOKEN_DATA, None, None, part))
-            if num < (len(parts) - 1):
-                tokens.append((self.TOKEN_NEWLINE, None, None, "\n"))
-        return tokens
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
-    def _parse_opts(self, data):
+    def stats(self):
         """
-        Given a tag string, this function will parse any options out of it and
-        return a tuple of (tag_name, options_dict). Options may be quoted in order
-        to preserve spaces, and free-standing options are allowed. The tag name
-        itself may also serve as an option if it is immediately followed by an equal
-        sign. Here are some examples:
-            quote author="Dan Watson"
-                tag_name=quote, options={'author': 'Dan Watson'}
-            url="http://test.com/s.php?a=bcd efg" popup
-                tag_name=url, options={'url': 'http://test.com/s.php?a=bcd efg', 'popup': ''}
+        Returns a dictionary of cache statistics.
         """
-        name = None
-        opts = CaseInsensitiveDict()
-        in_value = False
-        in_quote = False
-        attr = ""
-        value = ""
-        attr_done = False
-        stripped = data.strip()
-        ls = len(stripped)
-        pos = 0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
 
-        while pos < ls:
-            ch = stripped[pos]
-            if in_value:
-                if in_quote:
-                    if (
-                        ch == "\\"
-                        and ls > pos + 1
-                        and stripped[pos + 1] in ("\\", '"', "'")
-                    ):
-                        value += stripped[pos + 1]
-                        pos += 1
-                    elif ch == in_quote:
-                        in_quote = False
-                        in_value = False
-                        if attr:
-                            opts[attr] = value.strip()
-                        attr = ""
-                        value = ""
-                    else:
-                        value += ch
-                else:
-                    if ch in ('"', "'"):
-                        in_quote = ch
-                    elif ch == " " and data.find("=", pos + 1) > 0:
-                        # If there is no = after this, the value may accept spaces.
-                        opts[attr] = value.strip()
-                        attr = ""
-                        value = ""
-                        in_value = False
-                    else:
-                        value += ch
+
+class SQLiteRenderCache(object):
+    """
+    A render cache stored in a local SQLite database, so it can be shared by several
+    processes on the same host and survives restarts. The cache is bounded by a number
+    of entries and (optionally) by the total size of the cached output, in characters.
+    The least recently used entries are evicted every check_interval writes, so the
+    limits may be exceeded briefly. The hit, miss and eviction counts are kept for
+    this process only.
+    """
+
+    # How often (in seconds) the last access time of a cache hit is updated.
+    touch_interval = 60
+
+    def __init__(self, path, max_entries=100000, max_size=None, check_interval=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # Connections can't be shared between threads, or survive a fork.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Imported here, so that Python builds without sqlite3 can use the rest of
+            # the module.
+            import sqlite3
+
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS bbcode_cache "
+                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS bbcode_cache_accessed "
+                "ON bbcode_cache (accessed)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def __getstate__(self):
+        # Connections and locks can't be pickled, each process opens its own.
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        # Returns None (so nothing is cached) if the key isn't plain data.
+        if not _plain_data(key):
+            return None
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        return (
+            self._connect().execute("SELECT COUNT(*) FROM bbcode_cache").fetchone()[0]
+        )
+
+    def get(self, key):
+        """
+        Returns the cached output for the given key, or None.
+        """
+        key = self._key(key)
+        if key is None:
+            row = None
+        else:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, accessed FROM bbcode_cache WHERE key = ?", (key,)
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.touch_interval:
+            conn.execute(
+                "UPDATE bbcode_cache SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return row[0]
+
+    def set(self, key, value):
+        """
+        Caches the output for the given key.
+        """
+        size = len(value)
+        if self.max_size is not None and size > self.max_size:
+            return
+        key = self._key(key)
+        if key is None:
+            return
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO bbcode_cache (key, value, size, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, value, size, time.time()),
+        )
+        with self._lock:
+            self._writes += 1
+            check = self._writes % self.check_interval == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """
+        Evicts the least recently used entries until the cache is within its limits.
+        """
+        # The extra entries are found and deleted in SQL, and only the oldest entries
+        # are read when over max_size, so the write lock is only held briefly.
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            evicted = conn.execute(
+                "DELETE FROM bbcode_cache WHERE rowid IN (SELECT rowid FROM "
+                "bbcode_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            if self.max_size is not None:
+                total = conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM bbcode_cache"
+                ).fetchone()[0]
+                excess = total - self.max_size
+                rowids = []
+                if excess > 0:
+                    for rowid, size in conn.execute(
+                        "SELECT rowid, size FROM bbcode_cache ORDER BY accessed"
+                    ):
+                        rowids.append((rowid,))
+                        excess -= size
+                        if excess <= 0:
+                            break
+                conn.executemany("DELETE FROM bbcode_cache WHERE rowid = ?", rowids)
+                evicted += len(rowids)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        """
+        Removes all cached entries.
+        """
+        self._connect().execute("DELETE FROM bbcode_cache")
+
+    def stats(self):
+        """
+        Returns a dictionary of cache statistics.
+        """
+        entries, size = (
+            self._connect()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM bbcode_cache")
+            .fetchone()
+        )
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size": size,
+        }
+
+
+# A conversion specifier in a %-format string, with the mapping key (if any) and the
+# conversion type as groups.
+_format_spec_re = re.compile(
+    r"%(?:\(([^)]*)\))?[#0\- +]*(?:\*|\d+)?(?:\.(?:\*|\d+))?[hlL]?(.)", re.DOTALL
+)
+
+
+class ProfileStats(object):
+    """
+    A thread-safe profile callback for Parser, which adds up the number of calls and
+    the time taken by each phase of formatting, and by each tag's render function.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can't be pickled, and the times from another process aren't useful.
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def __call__(self, phase, name, elapsed):
+        key = (phase, name)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                self._stats[key] = [1, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+
+    def clear(self):
+        """
+        Forgets all of the recorded calls.
+        """
+        with self._lock:
+            self._stats = {}
+
+    def stats(self):
+        """
+        Returns a dictionary mapping each (phase, name) pair to a (calls, seconds)
+        tuple. The name is the tag name for the render phase, and None otherwise.
+        """
+        with self._lock:
+            return {key: tuple(entry) for key, entry in self._stats.items()}
+
+    def report(self):
+        """
+        Returns the recorded stats as a table, slowest first.
+        """
+        lines = [
+            "%-10s %-12s %10s %12s %12s" % ("phase", "name", "calls", "ms", "us/call")
+        ]
+        stats = sorted(self.stats().items(), key=lambda item: -item[1][1])
+        for (phase, name), (calls, elapsed) in stats:
+            lines.append(
+                "%-10s %-12s %10d %12.3f %12.3f"
+                % (phase, name or "", calls, elapsed * 1000, elapsed / calls * 1e6)
+            )
+        return "\n".join(lines)
+
+
+class _Histogram(object):
+    """
+    A histogram of observed values, counted in buckets by upper bound.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def exposition(self, name, help_text):
+        lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s histogram" % name]
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, total))
+        lines.append("%s_sum %s" % (name, self.sum))
+        lines.append("%s_count %d" % (name, self.count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    A thread-safe registry of rendering metrics for long-running processes, installed
+    for every parser in the process with set_metrics_registry. It keeps histograms of
+    the time taken by Parser.format and of the size of its input, in characters, and
+    of the number of tokens in each parsed text, and counts render cache hits and
+    misses, unrecognized and dropped tags, and inputs that exceeded each of the Parser
+    limits (max_input_length, max_tokens, max_links and deadline). Inputs that take at
+    least slow_threshold seconds to format are kept, along with the time taken, in a
+    ring buffer of the last slow_inputs of them.
+    """
+
+    LATENCY_BUCKETS = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+    )
+    SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+    TOKEN_BUCKETS = (8, 32, 128, 512, 2048, 8192, 32768, 131072)
+
+    def __init__(self, slow_threshold=None, slow_inputs=100):
+        self.slow_threshold = slow_threshold
+        self.max_slow_inputs = slow_inputs
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Resets all of the metrics, and forgets the slow inputs.
+        """
+        with self._lock:
+            self.format_seconds = _Histogram(self.LATENCY_BUCKETS)
+            self.input_chars = _Histogram(self.SIZE_BUCKETS)
+            self.tokens = _Histogram(self.TOKEN_BUCKETS)
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self.unrecognized_tags = 0
+            self.dropped_tags = 0
+            self.slow = 0
+            self.limits = {}
+            self._slow_inputs = deque(maxlen=self.max_slow_inputs)
+
+    def observe_format(self, data, elapsed):
+        """
+        Records a call to Parser.format with the given input, which took elapsed
+        seconds.
+        """
+        with self._lock:
+            self.format_seconds.observe(elapsed)
+            self.input_chars.observe(len(data))
+            if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+                self.slow += 1
+                self._slow_inputs.append((elapsed, data))
+
+    def observe_tokens(self, count, unrecognized, dropped):
+        """
+        Records the number of tokens in a parsed text, and the number of unrecognized
+        (but valid) tags that were left as text or dropped.
+        """
+        with self._lock:
+            self.tokens.observe(count)
+            self.unrecognized_tags += unrecognized
+            self.dropped_tags += dropped
+
+    def observe_cache(self, hit):
+        """
+        Records a render cache lookup.
+        """
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
             else:
-                if ch == "=":
-                    in_value = True
-                    if name is None:
-                        name = attr
-                elif ch == " ":
-                    attr_done = True
+                self.cache_misses += 1
+
+    def observe_limit(self, limit):
+        """
+        Records that the given Parser limit (such as "max_tokens") was exceeded.
+        """
+        with self._lock:
+            self.limits[limit] = self.limits.get(limit, 0) + 1
+
+    def slow_inputs(self):
+        """
+        Returns a list of (seconds, text) tuples for the most recent slow inputs,
+        oldest first.
+        """
+        with self._lock:
+            return list(self._slow_inputs)
+
+    def stats(self):
+        """
+        Returns a dictionary of the counts and totals.
+        """
+        with self._lock:
+            return {
+                "formats": self.format_seconds.count,
+                "format_seconds": self.format_seconds.sum,
+                "input_chars": self.input_chars.sum,
+                "tokens": self.tokens.sum,
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "unrecognized_tags": self.unrecognized_tags,
+                "dropped_tags": self.dropped_tags,
+                "slow_inputs": self.slow,
+                "limits_exceeded": dict(self.limits),
+            }
+
+    def exposition(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        counters = (
+            ("cache_hits", "Render cache hits in Parser.format."),
+            ("cache_misses", "Render cache misses in Parser.format."),
+            ("unrecognized_tags", "Valid tags that were not recognized."),
+            ("dropped_tags", "Unrecognized tags dropped by drop_unrecognized."),
+            ("slow_inputs", "Inputs that took at least the slow threshold to format."),
+        )
+        with self._lock:
+            lines = self.format_seconds.exposition(
+                "bbcode_format_seconds", "Time taken by Parser.format."
+            )
+            lines += self.input_chars.exposition(
+                "bbcode_input_chars", "Size of the input to Parser.format."
+            )
+            lines += self.tokens.exposition(
+                "bbcode_tokens", "Number of tokens in each parsed text."
+            )
+        stats = self.stats()
+        for name, help_text in counters:
+            lines.append("# HELP bbcode_%s_total %s" % (name, help_text))
+            lines.append("# TYPE bbcode_%s_total counter" % name)
+            lines.append("bbcode_%s_total %d" % (name, stats[name]))
+        lines.append(
+            "# HELP bbcode_limits_exceeded_total Inputs that exceeded a Parser limit."
+        )
+        lines.append("# TYPE bbcode_limits_exceeded_total counter")
+        for limit, count in sorted(stats["limits_exceeded"].items()):
+            lines.append('bbcode_limits_exceeded_total{limit="%s"} %d' % (limit, count))
+        return "\n".join(lines) + "\n"
+
+
+class _DeadlineExceeded(Exception):
+    """
+    Raised when the deadline for formatting a text passes, so that it is rendered as
+    plain text instead.
+    """
+
+
+# How many tokens are tokenized or formatted between checks of the deadline.
+_DEADLINE_CHECK_INTERVAL = 256
+
+
+def _limit_check(count, max_tokens, expires):
+    """
+    Returns the number of tokens at which the tokenizer should next check max_tokens
+    and the deadline (if any), given the current number of tokens.
+    """
+    check = sys.maxsize if expires is None else count + _DEADLINE_CHECK_INTERVAL
+    if max_tokens is not None:
+        check = min(check, max_tokens)
+    return check
+
+
+def _observe_limit(limit):
+    metrics = _g_metrics
+    if metrics is not None:
+        metrics.observe_limit(limit)
+
+
+class _LinkLimit(object):
+    """
+    Stands in for the link markup dict (if any) passed to Parser._transform while
+    rendering a document, counting the URLs linked. Once max_links have been linked,
+    get returns False, meaning the URL should be left as text.
+    """
+
+    __slots__ = ("link_markup", "remaining")
+
+    def __init__(self, link_markup, max_links):
+        self.link_markup = link_markup
+        self.remaining = max_links
+
+    def get(self, url):
+        if self.remaining <= 0:
+            if self.remaining == 0:
+                _observe_limit("max_links")
+                self.remaining = -1
+            return False
+        self.remaining -= 1
+        return None if self.link_markup is None else self.link_markup.get(url)
+
+
+class _ZeroMapping(dict):
+    """
+    A mapping with a 0 for every key, used to check that a format string is valid.
+    """
+
+    def __missing__(self, key):
+        return 0
+
+
+class SimpleFormatter(object):
+    """
+    A render function that takes the tag options dictionary, puts a value key in it,
+    and uses it as a format dictionary to the given format string. These are installed
+    by Parser.add_simple_formatter.
+
+    The format string is analysed once: if it only uses %(value)s, parts holds the
+    text around each use (and the formatter joins them with the value), and otherwise
+    keys holds the option names it uses (so only those are looked up). If neither
+    applies, every option is passed to the format string, as usual.
+    """
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+        self.parts = None
+        self.keys = None
+        # The literal text between uses of the value, and the text since the last one.
+        parts = []
+        text = []
+        keys = set()
+        value_only = True
+        pos = 0
+        for spec in _format_spec_re.finditer(format_string):
+            key, conversion = spec.groups()
+            text.append(format_string[pos : spec.start()])
+            pos = spec.end()
+            if spec.group(0) == "%%":
+                text.append("%")
+            elif key is None or "(" in key or "*" in spec.group(0) or conversion == "%":
+                # Leave anything unusual (or invalid) to the % operator.
+                return
+            else:
+                keys.add(key)
+                if spec.group(0) == "%(value)s":
+                    parts.append("".join(text))
+                    text = []
                 else:
-                    if attr_done:
-                        if attr:
-                            if name is None:
-                                name = attr
-                            else:
-                                opts[attr] = ""
-                        attr = ""
-                        attr_done = False
-                    attr += ch
-            pos += 1
-
-        if attr:
-            if name is None:
-                name = attr
-            opts[attr] = value.strip()
-        return name.lower(), opts
+                    value_only = False
+        if "%" in format_string[pos:]:
+            return
+        text.append(format_string[pos:])
+        parts.append("".join(text))
+        if value_only:
+            self.parts = parts
+            return
+        try:
+            format_string % _ZeroMapping()
+        except Exception:
+            return
+        self.keys = tuple(sorted(keys - {"value"}))
+
+    def __repr__(self):
+        return "SimpleFormatter(%r)" % self.format_string
+
+    def __call__(self, name, value, options, parent, context):
+        if self.parts is not None:
+            return str(value).join(self.parts)
+        fmt = {}
+        if self.keys is not None:
+            options = options or {}
+            for key in self.keys:
+                fmt[key] = options[key]
+        elif options:
+            fmt.update(options)
+        fmt.update({"value": value})
+        return self.format_string % fmt
+
+
+def _render_list(name, value, options, parent, context):
+    list_type = options["list"] if (options and "list" in options) else "*"
+    css_opts = {
+        "1": "decimal",
+        "01": "decimal-leading-zero",
+        "a": "lower-alpha",
+        "A": "upper-alpha",
+        "i": "lower-roman",
+        "I": "upper-roman",
+    }
+    tag = "ol" if list_type in css_opts else "ul"
+    css = (
+        ' style="list-style-type:%s;"' % css_opts[list_type]
+        if list_type in css_opts
+        else ""
+    )
+    return "<%s%s>%s</%s>" % (tag, css, value, tag)
+
+
+def _render_list_item(name, value, options, parent, context):
+    if not parent or parent.tag_name != "list":
+        return "[*]%s<br />" % value
+
+    return "<li>%s</li>" % value
+
+
+def _render_color(name, value, options, parent, context):
+    if "color" in options:
+        color = options["color"].strip()
+    elif options:
+        color = list(options.keys())[0].strip()
+    else:
+        return value
+    match = re.match(r"^([a-z]+)|^(#[a-f0-9]{3,6})", color, re.I)
+    color = match.group() if match else "inherit"
+    return '<span style="color:%(color)s;">%(value)s</span>' % {
+        "color": color,
+        "value": value,
+    }
+
+
+class Parser(object):
+    TOKEN_TAG_START = 1
+    TOKEN_TAG_END = 2
+    TOKEN_NEWLINE = 3
+    TOKEN_DATA = 4
+
+    REPLACE_ESCAPE = (
+        ("&", "&amp;"),
+        ("<", "&lt;"),
+        (">", "&gt;"),
+        ('"', "&quot;"),
+        ("'", "&#39;"),
+    )
+
+    REPLACE_COSMETIC = (
+        ("---", "&mdash;"),
+        ("--", "&ndash;"),
+        ("...", "&#8230;"),
+        ("(c)", "&copy;"),
+        ("(reg)", "&reg;"),
+        ("(tm)", "&trade;"),
+    )
+
+    def __init__(
+        self,
+        newline="<br />",
+        install_defaults=True,
+        escape_html=True,
+        replace_links=True,
+        replace_cosmetic=True,
+        tag_opener="[",
+        tag_closer="]",
+        linker=None,
+        linker_takes_context=False,
+        drop_unrecognized=False,
+        default_context=None,
+        max_tag_depth=None,
+        url_template='<a rel="nofollow" href="{href}">{text}</a>',
+        cache=None,
+        cosmetic_replacements=None,
+        bulk_linker=None,
+        link_cache=None,
+        profile=None,
+        max_input_length=None,
+        max_tokens=None,
+        max_links=None,
+        deadline=None,
+    ):
+        self.tag_opener = tag_opener
+        self.tag_closer = tag_closer
+        self.newline = newline
+        self.recognized_tags = {}
+        self.drop_unrecognized = drop_unrecognized
+        self.escape_html = escape_html
+        self.replace_cosmetic = replace_cosmetic
+        self.replace_links = replace_links
+        self.linker = linker
+        self.linker_takes_context = linker_takes_context
+        self.bulk_linker = bulk_linker
+        self.link_cache = link_cache
+        self.max_tag_depth = max_tag_depth or sys.getrecursionlimit()
+        self.url_template = url_template
+        self.default_context = default_context or {}
+        self.cache = cache
+        self.profile = profile
+        self.max_input_length = max_input_length
+        self.max_tokens = max_tokens
+        self.max_links = max_links
+        self.deadline = deadline
+        self.cosmetic_replacements = self._cosmetic_table(cosmetic_replacements)
+        self._replacement_tables = {}
+        self._fingerprints = {}
+        if install_defaults:
+            self.install_default_formatters()
+
+    def _cosmetic_table(self, cosmetic_replacements):
+        if cosmetic_replacements is None:
+            cosmetic_replacements = self.REPLACE_COSMETIC
+        if not isinstance(cosmetic_replacements, ReplacementTable):
+            cosmetic_replacements = ReplacementTable(cosmetic_replacements)
+        return cosmetic_replacements
+
+    def derive(self, tags_enabled=None, tags_disabled=None, **overrides):
+        """
+        Returns a new parser with this parser's configuration and formatters, except
+        for the given overrides, which can be any of the keyword arguments of Parser
+        (other than install_defaults). If tags_enabled is given, only the tags named in
+        it are recognized, and tags named in tags_disabled are not recognized.
+
+        The new parser shares the tag table, compiled replacement tables and cache
+        with this one, so it is cheap to create. Installing formatters on either parser
+        only changes that parser, but the TagOptions of shared tags are the same
+        objects, so derive from a frozen parser (the result is frozen too) if they
+        might be changed.
+        """
+        # Fingerprints that the overrides don't affect are carried over.
+        self.render_fingerprint()
+        state = dict(vars(self))
+        for name in overrides:
+            if name not in _PARSER_OPTIONS:
+                raise TypeError("derive() got an unexpected keyword argument %r" % name)
+        if "max_tag_depth" in overrides:
+            overrides["max_tag_depth"] = (
+                overrides["max_tag_depth"] or sys.getrecursionlimit()
+            )
+        if "cosmetic_replacements" in overrides:
+            overrides["cosmetic_replacements"] = self._cosmetic_table(
+                overrides["cosmetic_replacements"]
+            )
+            state["_replacement_tables"] = {}
+        state.update(overrides)
+        state["default_context"] = dict(state["default_context"] or {})
+        if tags_enabled is not None or tags_disabled is not None:
+            if tags_enabled is not None:
+                tags_enabled = {name.strip().lower() for name in tags_enabled}
+            tags_disabled = {name.strip().lower() for name in tags_disabled or ()}
+            state["recognized_tags"] = {
+                name: entry
+                for name, entry in self.recognized_tags.items()
+                if (tags_enabled is None or name in tags_enabled)
+                and name not in tags_disabled
+            }
+        fingerprints = {}
+        if tags_enabled is None and tags_disabled is None:
+            if not overrides.keys() & _PARSE_OPTIONS:
+                fingerprints = {"parse": state["_fingerprints"].get("parse")}
+            if not overrides.keys() - _UNFINGERPRINTED_OPTIONS:
+                fingerprints["render"] = state["_fingerprints"].get("render")
+        state["_fingerprints"] = {
+            kind: fingerprint
+            for kind, fingerprint in fingerprints.items()
+            if fingerprint is not None
+        }
+        return self._derived(state)
+
+    def _derived(self, state):
+        parser = type(self).__new__(type(self))
+        parser.__dict__.update(state)
+        return parser
+
+    def add_formatter(self, tag_name, render_func, **kwargs):
+        """
+        Installs a render function for the specified tag name. The render function
+        should have the following signature:
+
+            def render(tag_name, value, options, parent, context)
+
+        The arguments are as follows:
+
+            tag_name
+                The name of the tag being rendered.
+            value
+                The context between start and end tags, or None for standalone tags.
+                Whether this has been rendered depends on render_embedded tag option.
+            options
+                A dictionary of options specified on the opening tag.
+            parent
+                The parent TagOptions, if the tag is being rendered inside another tag,
+                otherwise None.
+            context
+                The keyword argument dictionary passed into the format call.
+        """
+        options = TagOptions(tag_name.strip().lower(), **kwargs)
+        # Replace the tag table (and forget the fingerprints) instead of changing it,
+        # so that other threads formatting with this parser always see a whole table.
+        recognized_tags = dict(self.recognized_tags)
+        recognized_tags[options.tag_name] = (render_func, options)
+        self.recognized_tags = recognized_tags
+        self._fingerprints = {}
+
+    def clear_cache(self):
+        """
+        Forgets the fingerprints of the parser configuration and its compiled
+        replacement tables, and removes all entries from the render cache (if any). This should be called after changing parser
+        attributes, such as newline or recognized_tags, directly. Installing formatters
+        with add_formatter does this automatically.
+        """
+        self._fingerprints = {}
+        self._replacement_tables = {}
+        if self.cache is not None:
+            self.cache.clear()
+
+    def freeze(self):
+        """
+        Returns a FrozenParser with a copy of this parser's configuration, which can't
+        be changed, and can be shared by any number of threads. Changes made to this
+        parser afterwards don't affect the frozen copy.
+        """
+        return FrozenParser(self)
+
+    def add_simple_formatter(self, tag_name, format_string, **kwargs):
+        """
+        Installs a formatter that takes the tag options dictionary, puts a value key
+        in it, and uses it as a format dictionary to the given format string.
+        """
+        self.add_formatter(tag_name, SimpleFormatter(format_string), **kwargs)
+
+    def install_default_formatters(self):
+        """
+        Installs default formatters for the following tags:
+
+            b, i, u, s, list (and *), quote, code, center, color, url
+        """
+        self.add_simple_formatter("b", "<strong>%(value)s</strong>")
+        self.add_simple_formatter("i", "<em>%(value)s</em>")
+        self.add_simple_formatter("u", "<u>%(value)s</u>")
+        self.add_simple_formatter("s", "<strike>%(value)s</strike>")
+        self.add_simple_formatter("hr", "<hr />", standalone=True)
+        self.add_simple_formatter("sub", "<sub>%(value)s</sub>")
+        self.add_simple_formatter("sup", "<sup>%(value)s</sup>")
+        self.add_formatter(
+            "list",
+            _render_list,
+            transform_newlines=False,
+            strip=True,
+            swallow_trailing_newline=True,
+        )
+        # Make sure transform_newlines = False for [*], so [code] tags can be embedded
+        # without transformation.
+        self.add_formatter(
+            "*",
+            _render_list_item,
+            newline_closes=True,
+            transform_newlines=False,
+            same_tag_closes=True,
+            strip=True,
+        )
+        self.add_simple_formatter(
+            "quote",
+            "<blockquote>%(value)s</blockquote>",
+            strip=True,
+            swallow_trailing_newline=True,
+        )
+        self.add_simple_formatter(
+            "code",
+            "<code>%(value)s</code>",
+            render_embedded=False,
+            transform_newlines=False,
+            swallow_trailing_newline=True,
+            replace_cosmetic=False,
+        )
+        self.add_simple_formatter(
+            "center", '<div style="text-align:center;">%(value)s</div>'
+        )
+        self.add_formatter("color", _render_color)
+        self.add_formatter(
+            "url", self._render_url, replace_links=False, replace_cosmetic=False
+        )
+
+    def _render_url(self, name, value, options, parent, context):
+        if options and "url" in options:
+            # Option values are not escaped for HTML output.
+            href = self._replace(options["url"], self.REPLACE_ESCAPE)
+        else:
+            href = value
+        # Completely ignore javascript: and data: "links".
+        if re.sub(r"[^a-z0-9+]", "", href.lower().split(":", 1)[0]) in (
+            "javascript",
+            "data",
+            "vbscript",
+        ):
+            return ""
+        # Only add the missing http:// if it looks like it starts with a domain name.
+        if "://" not in href and _domain_re.match(href):
+            href = "http://" + href
+        return self.url_template.format(href=href.replace('"', "%22"), text=value)
+
+    def _replace(self, data, replacements):
+        """
+        Given a list of 2-tuples (find, repl) this function performs all
+        replacements on the input and returns the result.
+        """
+        for find, repl in replacements:
+            data = data.replace(find, repl)
+        return data
+
+    def _newline_tokenize(self, data):
+        """
+        Given a string that does not contain any tags, this function will
+        return a list of NEWLINE and DATA tokens such that if you concatenate
+        their data, you will have the original string.
+        """
+        parts = data.split("\n")
+        tokens = []
+        for num, part in enumerate(parts):
+            if part:
+                tokens.append((self.TOKEN_DATA, None, None, part))
+            if num < (len(parts) - 1):
+                tokens.append((self.TOKEN_NEWLINE, None, None, "\n"))
+        return tokens
+
+    def _parse_opts(self, data):
+        """
+        Given a tag string, this function will parse any options out of it and
+        return a tuple of (tag_name, options_dict). Options may be quoted in order
+        to preserve spaces, and free-standing options are allowed. The tag name
+        itself may also serve as an option if it is immediately followed by an equal
+        sign. Here are some examples:
+            quote author="Dan Watson"
+                tag_name=quote, options={'author': 'Dan Watson'}
+            url="http://test.com/s.php?a=bcd efg" popup
+                tag_name=url, options={'url': 'http://test.com/s.php?a=bcd efg', 'popup': ''}
+        """
+        if len(data) <= _PARSE_OPTIONS_MEMO_MAX_LENGTH:
+            return _parse_tag_options_memo(data)
+        return _parse_tag_options(data)
 
     def _parse_tag(self, tag):
         """
@@ -448,32 +1638,6 @@ class Parser(object):
             tag_name, opts = self._parse_opts(tag_name)
         return (True, tag_name.strip().lower(), closer, opts)
 
-    def _tag_extent(self, data, start):
-        """
-        Finds the extent of a tag, accounting for option quoting and new tags starting
-        before the current one closes. Returns (found_close, end_pos) where valid is
-        False if another tag started before this one closed.
-        """
-        in_quote = False
-        quotable = False
-        lto = len(self.tag_opener)
-        ltc = len(self.tag_closer)
-        for i in range(start + 1, len(data)):
-            ch = data[i]
-            if ch == "=":
-                quotable = True
-            if ch in ('"', "'"):
-                if quotable and not in_quote:
-                    in_quote = ch
-                elif in_quote == ch:
-                    in_quote = False
-                    quotable = False
-            if not in_quote and data[i : i + lto] == self.tag_opener:
-                return i, False
-            if not in_quote and data[i : i + ltc] == self.tag_closer:
-                return i + ltc, True
-        return len(data), False
-
     def tokenize(self, data):
         """
         Tokenizes the given string. A token is a 4-tuple of the form:
@@ -489,11 +1653,72 @@ class Parser(object):
             token_text
                 The original token text
         """
+        return self._phase("tokenize", self._tokenize, data)[0]
+
+    def _phase(self, phase, func, *args):
+        """
+        Calls func with the given arguments, reporting the time taken to the profile
+        callback (if any) as the given phase of formatting.
+        """
+        if self.profile is None:
+            return func(*args)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.profile(phase, None, time.perf_counter() - start)
+
+    def _profiled(self, phase, name, func):
+        """
+        Returns a function that calls func, reporting the time taken to the profile
+        callback as the given phase and name.
+        """
+        profile = self.profile
+
+        def call(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                profile(phase, name, time.perf_counter() - start)
+
+        return call
+
+    def _tokenize(self, data, final=True, expires=None, max_tokens=None):
+        """
+        Tokenizes the given string, returning a tuple of (tokens, barrier). If final is
+        False, the string is only the start of a longer text, so tokenizing stops at any
+        tag that may still be closed by the text that follows. Newline tokens before
+        the barrier index may be part of tag-like text, so the text can't be split at
+        them (see Parser._stream_cut). The text is cut short at max_input_length, and
+        the tokens at max_tokens (which defaults to the parser's max_tokens). If
+        expires (a time.perf_counter value) passes while tokenizing, _DeadlineExceeded
+        is raised.
+        """
+        if self.max_input_length is not None and len(data) > self.max_input_length:
+            data = data[: self.max_input_length]
+            _observe_limit("max_input_length")
         data = data.replace("\r\n", "\n").replace("\r", "\n")
-        pos = start = end = 0
+        pos = start = end = barrier = 0
+        unrecognized = dropped = 0
+        truncated = False
         ld = len(data)
         tokens = []
+        tag_extent = _tag_extent_re(self.tag_opener, self.tag_closer).match
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        # The number of tokens at which to check the limits next.
+        check = _limit_check(0, max_tokens, expires)
         while pos < ld:
+            if len(tokens) >= check:
+                if max_tokens is not None and len(tokens) >= max_tokens:
+                    # Drop the rest of the text.
+                    truncated = True
+                    pos = ld
+                    break
+                if expires is not None and time.perf_counter() > expires:
+                    raise _DeadlineExceeded()
+                check = _limit_check(len(tokens), max_tokens, expires)
             start = data.find(self.tag_opener, pos)
             if start >= pos:
                 # Check to see if there was data between this start and the last end.
@@ -503,8 +1728,11 @@ class Parser(object):
                     pos = start
 
                 # Find the extent of this tag, if it's ever closed.
-                end, found_close = self._tag_extent(data, start)
-                if found_close:
+                extent = tag_extent(data, start + 1)
+                end = extent.end()
+                if end == ld and not final and extent.group("close") is None:
+                    return tokens, barrier
+                if extent.group("close") is not None:
                     tag = data[start:end]
                     valid, tag_name, closer, opts = self._parse_tag(tag)
                     # Make sure this is a well-formed, recognized tag, otherwise it's
@@ -520,12 +1748,17 @@ class Parser(object):
                         and tag_name not in self.recognized_tags
                     ):
                         # If we found a valid (but unrecognized) tag and self.drop_unrecognized is True, just drop it.
-                        pass
+                        dropped += 1
                     else:
+                        if valid:
+                            unrecognized += 1
                         tokens.extend(self._newline_tokenize(tag))
+                        if "\n" in tag:
+                            barrier = len(tokens)
                 else:
                     # We didn't find a closing tag, tack it on as text.
                     tokens.extend(self._newline_tokenize(data[start:end]))
+                    barrier = len(tokens)
                 pos = end
             else:
                 # No more tags left to parse.
@@ -533,241 +1766,1252 @@ class Parser(object):
         if pos < ld:
             tl = self._newline_tokenize(data[pos:])
             tokens.extend(tl)
-        return tokens
+        if max_tokens is not None and len(tokens) > max_tokens:
+            del tokens[max_tokens:]
+            truncated = True
+        if truncated and final:
+            _observe_limit("max_tokens")
+        metrics = _g_metrics
+        if final and metrics is not None:
+            metrics.observe_tokens(len(tokens), unrecognized, dropped)
+        return tokens, barrier
+
+    def _pair_tokens(self, tokens):
+        """
+        Given a list of tokens, this function finds the closing token of every start
+        tag in a single pass. The closing token may be a closing tag, a newline, or
+        simply the end of the list (to ensure tags are closed). Returns a list with a
+        (end_pos, consume) tuple for each non-standalone start tag and None for every
+        other token, where consume indicates whether the ending token should be consumed
+        or not. When rendering a tag nested inside another, any end_pos past the end of
+        the parent should be treated as (parent_end, True).
+        """
+        recognized_tags = self.recognized_tags
+        closing = [None] * len(tokens)
+        # Start tags that render embedded tags, by name. These nest, so the next end tag
+        # of the same name closes the most recent one.
+        nested = {}
+        # Start tags that are closed by the next end tag of the same name (or, for tags
+        # with same_tag_closes, the next start tag of the same name).
+        waiting = {}
+        # Start tags that are closed by a newline, keyed by the number of open tags that
+        # don't transform newlines (i.e. a code tag that keeps newlines intact) at the
+        # time they started. A newline only closes them when back at the same count.
+        newline_waiting = {}
+        block_count = 0
+        for pos, (token_type, tag_name, tag_opts, token_text) in enumerate(tokens):
+            if token_type == self.TOKEN_DATA:
+                continue
+            if token_type == self.TOKEN_NEWLINE:
+                # If for some crazy reason there are embedded tags that both close on
+                # newline, the first newline will automatically close all those nested
+                # tags.
+                for start in newline_waiting.pop(block_count, ()):
+                    if closing[start] is None:
+                        closing[start] = (pos, True)
+                continue
+            flags = recognized_tags[tag_name][1].flags
+            if token_type == self.TOKEN_TAG_START:
+                if not flags & TagOptions.TRANSFORM_NEWLINES:
+                    block_count += 1
+                if flags & TagOptions.SAME_TAG_CLOSES:
+                    for start in waiting.pop(tag_name, ()):
+                        if closing[start] is None:
+                            closing[start] = (pos, False)
+                if flags & TagOptions.STANDALONE:
+                    continue
+                if flags & TagOptions.RENDER_EMBEDDED and not (
+                    flags & TagOptions.SAME_TAG_CLOSES
+                ):
+                    nested.setdefault(tag_name, []).append(pos)
+                else:
+                    waiting.setdefault(tag_name, []).append(pos)
+                if flags & TagOptions.NEWLINE_CLOSES:
+                    newline_waiting.setdefault(block_count, []).append(pos)
+            else:
+                if not flags & TagOptions.TRANSFORM_NEWLINES:
+                    block_count -= 1
+                if tag_name in nested:
+                    # Tags closed early (by a newline) stay on the stack, so they are
+                    # still counted when matching end tags to the tags around them.
+                    stack = nested[tag_name]
+                    start = stack.pop()
+                    if not stack:
+                        del nested[tag_name]
+                    if closing[start] is None:
+                        closing[start] = (pos, True)
+                for start in waiting.pop(tag_name, ()):
+                    if closing[start] is None:
+                        closing[start] = (pos, True)
+        end = (len(tokens), True)
+        for stack in list(nested.values()) + list(waiting.values()):
+            for start in stack:
+                if closing[start] is None:
+                    closing[start] = end
+        return closing
+
+    def _link_replace(self, url, **context):
+        """
+        Replaces link text with markup, using the linker if there is one (this is the
+        hook for user customization). linker_takes_context=True means that the linker
+        gets passed context like a standard format function.
+        """
+        if self.linker:
+            if self.linker_takes_context:
+                return self.linker(url, context)
+            else:
+                return self.linker(url)
+        else:
+            href = url
+            if "://" not in href:
+                href = "http://" + href
+            # Escape quotes to avoid XSS, let the browser escape the rest.
+            return self.url_template.format(href=href.replace('"', "%22"), text=url)
+
+    def _link_markup(self, urls, context):
+        """
+        Returns a dict mapping each distinct URL to its link markup. URLs found in the
+        link_cache are not linked again, and the rest are passed to the bulk_linker in
+        a single call, or to _link_replace one at a time if there is no bulk_linker.
+        """
+        link_markup = {}
+        missing = []
+        cache_key = None
+        if self.link_cache is not None:
+            cache_key = self._context_key(context)
+        for url in urls:
+            if url in link_markup:
+                continue
+            link = None
+            if cache_key is not None:
+                link = self.link_cache.get(cache_key + (url,))
+            if link is None:
+                missing.append(url)
+            link_markup[url] = link
+        if not missing:
+            return link_markup
+        if self.bulk_linker is None:
+            links = [self._link_replace(url, **context) for url in missing]
+        elif self.linker_takes_context:
+            links = self.bulk_linker(missing, context)
+        else:
+            links = self.bulk_linker(missing)
+        links = list(links)
+        if len(links) != len(missing):
+            raise ValueError(
+                "bulk_linker returned %d links for %d URLs" % (len(links), len(missing))
+            )
+        for url, link in zip(missing, links):
+            link_markup[url] = link
+            if cache_key is not None:
+                self.link_cache.set(cache_key + (url,), link)
+        return link_markup
+
+    def _transform(self, data, flags, link_markup, context):
+        """
+        Transforms the input string based on the escape_html, replace_links,
+        replace_cosmetic and transform_newlines bits of the TagOptions flags given,
+        taking into account whether links are replaced globally for this parser. Links
+        are found in a single pass over the input, and the text between them is escaped
+        and replaced. Link markup is looked up in link_markup (from _link_markup), if
+        given.
+        """
+        table = self._replacement_tables.get(flags & _REPLACEMENT_FLAGS)
+        if table is None:
+            table = self._replacement_table(flags & _REPLACEMENT_FLAGS)
+        if flags & TagOptions.REPLACE_LINKS and self.replace_links:
+            # If we're replacing links in the text (i.e. not those in [url] tags) then
+            # the link text must not be escaped or replaced, so only replace the text
+            # between links.
+            parts = []
+            pos = 0
+            for start, end in _find_urls(data):
+                parts.append(table.replace(data[pos:start]))
+                url = data[start:end]
+                link = link_markup.get(url) if link_markup is not None else None
+                if link is None:
+                    link = self._link_replace(url, **context)
+                elif link is False:
+                    # Past max_links, so leave it as text.
+                    link = table.replace(url)
+                if flags & TagOptions.TRANSFORM_NEWLINES:
+                    link = link.replace("\n", "\r")
+                parts.append(link)
+                pos = end
+            if parts:
+                parts.append(table.replace(data[pos:]))
+                return "".join(parts)
+        return table.replace(data)
+
+    def _replacement_table(self, flags):
+        """
+        Returns the table that escapes HTML, makes cosmetic replacements and marks
+        newlines, as specified by the TagOptions flags, compiling it the first time it's
+        used.
+        """
+        table = self._compile_replacement_table(flags)
+        self._replacement_tables[flags] = table
+        return table
+
+    def _compile_replacement_table(self, flags):
+        """
+        Compiles the replacement table for the given TagOptions flags. Cosmetic
+        replacements are matched against the escaped text, so they are only made in the
+        same pass as escaping if none of them could match an escaped character (as
+        with REPLACE_COSMETIC). Otherwise (say, for a ("&lt;3", "&hearts;") entry) the
+        text is escaped first, and the rest of the replacements are made in a second
+        pass.
+        """
+        replacements = []
+        if flags & TagOptions.ESCAPE_HTML:
+            replacements.extend(self.REPLACE_ESCAPE)
+        if flags & TagOptions.REPLACE_COSMETIC:
+            if replacements and not _escape_independent(
+                self.REPLACE_ESCAPE, self.cosmetic_replacements
+            ):
+                escape = ReplacementTable(replacements)
+                replacements = list(self.cosmetic_replacements)
+                if flags & TagOptions.TRANSFORM_NEWLINES:
+                    replacements.append(("\n", "\r"))
+                return _ReplacementChain((escape, ReplacementTable(replacements)))
+            replacements.extend(self.cosmetic_replacements)
+        if flags & TagOptions.TRANSFORM_NEWLINES:
+            replacements.append(("\n", "\r"))
+        return ReplacementTable(replacements)
+
+    def _format_tokens(
+        self,
+        tokens,
+        closing,
+        link_markup=None,
+        expires=None,
+        /,
+        escape_html=None,
+        replace_links=None,
+        replace_cosmetic=None,
+        transform_newlines=True,
+        **context,
+    ):
+        """
+        Renders a list of tokens, given the closing tokens found by _pair_tokens. Tags
+        are rendered from index ranges into the token list, using an explicit stack of
+        the enclosing tags instead of recursion, so nesting depth is only limited by
+        max_tag_depth. Link markup is passed along to _transform. If expires (a
+        time.perf_counter value) passes while formatting, _DeadlineExceeded is raised.
+        """
+        # Allow the parser defaults to be overridden when formatting. The options for
+        # top-level text are kept as TagOptions flags, like those of tags.
+        escape_html = self.escape_html if escape_html is None else escape_html
+        replace_links = self.replace_links if replace_links is None else replace_links
+        replace_cosmetic = (
+            self.replace_cosmetic if replace_cosmetic is None else replace_cosmetic
+        )
+        top_flags = (
+            (TagOptions.ESCAPE_HTML if escape_html else 0)
+            | (TagOptions.REPLACE_LINKS if replace_links else 0)
+            | (TagOptions.REPLACE_COSMETIC if replace_cosmetic else 0)
+            | (TagOptions.TRANSFORM_NEWLINES if transform_newlines else 0)
+        )
+        recognized_tags = self.recognized_tags
+        transform = self._transform
+        if self.profile is not None:
+            # Time every render function and transform. This also bypasses the inline
+            # rendering of simple formatters below, so they are timed too.
+            recognized_tags = {
+                name: (self._profiled("render", name, render_func), tag)
+                for name, (render_func, tag) in recognized_tags.items()
+            }
+            transform = self._profiled("transform", None, transform)
+        # Each entry holds the state needed to resume rendering the enclosing tag:
+        # (render_func, start_idx, end_idx, stop, parent, formatted)
+        stack = []
+        formatted = []
+        parent = None
+        flags = top_flags
+        idx = 0
+        stop = len(tokens)
+        # The token index at which to check the deadline next.
+        check = sys.maxsize if expires is None else _DEADLINE_CHECK_INTERVAL
+        while True:
+            while idx < stop:
+                if idx >= check:
+                    if time.perf_counter() > expires:
+                        raise _DeadlineExceeded()
+                    check = idx + _DEADLINE_CHECK_INTERVAL
+                token_type, tag_name, tag_opts, token_text = tokens[idx]
+                if token_type == self.TOKEN_DATA:
+                    formatted.append(transform(token_text, flags, link_markup, context))
+                elif token_type == self.TOKEN_TAG_START:
+                    render_func, tag = recognized_tags[tag_name]
+                    tag_flags = tag.flags
+                    if tag_flags & TagOptions.STANDALONE:
+                        formatted.append(
+                            render_func(tag_name, None, tag_opts, parent, context)
+                        )
+                    else:
+                        # First, find the extent of this tag's tokens. A tag is never
+                        # rendered past the end of its parent.
+                        end, consume = closing[idx]
+                        if end >= stop:
+                            end, consume = stop, True
+                        inner_end = end
+                        # If the end tag should not be consumed, back up one.
+                        if not consume:
+                            end = end - 1
+                        # If the tag should swallow the first trailing newline, check
+                        # the token after the closing token.
+                        if tag_flags & TagOptions.SWALLOW_TRAILING_NEWLINE:
+                            next_pos = end + 1
+                            if (
+                                next_pos < stop
+                                and tokens[next_pos][0] == self.TOKEN_NEWLINE
+                            ):
+                                end = next_pos
+                        stack.append((render_func, idx, end, stop, parent, formatted))
+                        if (
+                            tag_flags & TagOptions.RENDER_EMBEDDED
+                            and len(stack) < self.max_tag_depth
+                        ):
+                            # This tag renders embedded tags, so render its tokens next.
+                            formatted = []
+                            idx = idx + 1
+                        else:
+                            # Otherwise, just concatenate all the token text.
+                            text = "".join([t[3] for t in tokens[idx + 1 : inner_end]])
+                            formatted = [
+                                transform(text, tag_flags, link_markup, context)
+                            ]
+                            idx = inner_end
+                        stop = inner_end
+                        parent = tag
+                        flags = tag_flags
+                        continue
+                elif token_type == self.TOKEN_NEWLINE:
+                    # If this is a top-level newline, replace it. Otherwise, it will be
+                    # replaced (if necessary) when the enclosing tag is rendered.
+                    formatted.append(
+                        "\r"
+                        if parent is None or flags & TagOptions.TRANSFORM_NEWLINES
+                        else token_text
+                    )
+                idx += 1
+            if not stack:
+                break
+            # All of the tokens inside the current tag have been rendered, so render the
+            # tag itself and resume with the tokens after its closing token.
+            inner = "".join(formatted)
+            if flags & TagOptions.STRIP:
+                inner = inner.strip()
+            render_func, start, end, stop, parent, formatted = stack.pop()
+            flags = top_flags if parent is None else parent.flags
+            if type(render_func) is SimpleFormatter and render_func.parts is not None:
+                # Simple formatters that only use the value are just concatenation.
+                formatted.append(inner.join(render_func.parts))
+            else:
+                token_type, tag_name, tag_opts, token_text = tokens[start]
+                formatted.append(
+                    render_func(tag_name, inner, tag_opts, parent, context)
+                )
+            idx = end + 1
+        return "".join(formatted)
+
+    def parse_fingerprint(self):
+        """
+        Returns a string identifying the parts of the parser configuration that affect
+        how text is parsed: the delimiters, the recognized tags and their options, and
+        drop_unrecognized. Documents parsed by parsers with the same fingerprint have
+        the same tokens.
+        """
+        # If the configuration changes while this runs, the fingerprint is stored in
+        # the forgotten dict.
+        fingerprints = self._fingerprints
+        fingerprint = fingerprints.get("parse")
+        if fingerprint is None:
+            tags = sorted(
+                (name, [getattr(tag, attr) for attr in _TAG_OPTIONS])
+                for name, (render_func, tag) in self.recognized_tags.items()
+            )
+            config = [
+                self.tag_opener,
+                self.tag_closer,
+                self.drop_unrecognized,
+                tags,
+                self.max_input_length,
+                self.max_tokens,
+            ]
+            fingerprint = fingerprints["parse"] = self._hash(config)
+        return fingerprint
+
+    def render_fingerprint(self):
+        """
+        Returns a string identifying the parser configuration that affects rendered
+        output: everything in parse_fingerprint, plus the render functions, linker,
+        replacements and other formatting options. Render functions are identified by
+        name (and the attributes of callable objects), so changes to their code are not
+        detected. Returns None if a render function or linker is a callable object
+        whose attributes aren't plain data, so it can't be told apart from another
+        object of the same class; output is not cached then.
+        """
+        fingerprints = self._fingerprints
+        if "render" in fingerprints:
+            return fingerprints["render"]
+        try:
+            renderers = sorted(
+                (name, _callable_name(render_func))
+                for name, (render_func, tag) in self.recognized_tags.items()
+            )
+            linkers = [_callable_name(self.linker), _callable_name(self.bulk_linker)]
+        except _Unidentifiable:
+            fingerprint = None
+        else:
+            config = [
+                __version__,
+                self.parse_fingerprint(),
+                renderers,
+                self.newline,
+                self.escape_html,
+                self.replace_links,
+                self.replace_cosmetic,
+                linkers,
+                self.linker_takes_context,
+                self.max_tag_depth,
+                self.max_links,
+                self.url_template,
+                self.REPLACE_ESCAPE,
+                list(self.cosmetic_replacements),
+            ]
+            fingerprint = self._hash(config)
+        fingerprints["render"] = fingerprint
+        return fingerprint
+
+    def _hash(self, config):
+        return hashlib.sha1(
+            json.dumps(config, default=repr).encode("utf-8")
+        ).hexdigest()
+
+    def parse(self, data):
+        """
+        Tokenizes the input text and returns a Document, which can be rendered, stripped
+        or inspected any number of times without parsing the text again.
+        """
+        return Document(self, self.tokenize(data))
+
+    def loads(self, blob):
+        """
+        Loads a Document saved with Document.dumps. If the document was saved by a
+        different version of this library, or by a parser with a different
+        parse_fingerprint, the text is parsed again. Note that any tags dropped by a
+        parser with drop_unrecognized=True are not part of the saved document.
+        """
+        saved = json.loads(blob)
+        if (
+            saved.get("v") != Document.SERIAL_VERSION
+            or saved.get("fp") != self.parse_fingerprint()
+        ):
+            text = [t[1] if t[0] != self.TOKEN_NEWLINE else "\n" for t in saved["t"]]
+            return self.parse("".join(text))
+        tokens = []
+        for token in saved["t"]:
+            token_type = token[0]
+            if token_type == self.TOKEN_TAG_START:
+                opts = FrozenCaseInsensitiveDict(token[3]) if token[3] else {}
+                tokens.append((token_type, token[2], opts, token[1]))
+            elif token_type == self.TOKEN_TAG_END:
+                tokens.append((token_type, token[2], None, token[1]))
+            elif token_type == self.TOKEN_NEWLINE:
+                tokens.append((token_type, None, None, "\n"))
+            else:
+                tokens.append((token_type, None, None, token[1]))
+        doc = Document(self, tokens)
+        doc._closing = [tuple(c) if c is not None else None for c in saved["c"]]
+        return doc
+
+    def format(self, data, **context):
+        """
+        Formats the input text using any installed renderers. Any context keyword
+        arguments given here will be passed along to the render functions as a context
+        dictionary. If the parser has a cache, the output is cached by the input text,
+        the full context (if its values are all hashable), and render_fingerprint.
+        """
+        metrics = _g_metrics
+        if self.profile is None and metrics is None:
+            return self._format(data, context)
+        start = time.perf_counter()
+        try:
+            return self._format(data, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.profile is not None:
+                self.profile("format", None, elapsed)
+            if metrics is not None:
+                metrics.observe_format(data, elapsed)
+
+    def _format(self, data, context):
+        if self.cache is not None:
+            key = self._cache_key(data, context)
+            if key is not None:
+                html = self.cache.get(key)
+                metrics = _g_metrics
+                if metrics is not None:
+                    metrics.observe_cache(html is not None)
+                if html is None:
+                    html, complete = self._render_text(data, context)
+                    # Plain text rendered after the deadline passed isn't cached.
+                    if complete:
+                        self.cache.set(key, html)
+                return html
+        return self._render_text(data, context)[0]
+
+    def _render_text(self, data, context):
+        """
+        Parses and renders the input text, returning a tuple of the output and whether
+        it was rendered in full (False if the deadline passed, and the text was
+        rendered as plain text instead).
+        """
+        expires = self._expires()
+        try:
+            tokens = self._phase("tokenize", self._tokenize, data, True, expires)[0]
+            return Document(self, tokens)._render_by(context, expires), True
+        except _DeadlineExceeded:
+            return self._plain_text(data), False
+
+    def _expires(self):
+        """
+        Returns the time.perf_counter value at which formatting text that starts now
+        should stop, or None if there is no deadline.
+        """
+        if self.deadline is None:
+            return None
+        return time.perf_counter() + self.deadline
+
+    def _plain_text(self, data):
+        """
+        Returns the input text (up to max_input_length) escaped and with newlines
+        replaced, but otherwise as is, for when the deadline passes.
+        """
+        _observe_limit("deadline")
+        if self.max_input_length is not None:
+            data = data[: self.max_input_length]
+        data = data.replace("\r\n", "\n").replace("\r", "\n")
+        flags = TagOptions.TRANSFORM_NEWLINES
+        if self.escape_html:
+            flags |= TagOptions.ESCAPE_HTML
+        table = self._replacement_tables.get(flags)
+        if table is None:
+            table = self._replacement_table(flags)
+        return table.replace(data).replace("\r", self.newline)
+
+    def _full_context(self, context):
+        """
+        Returns the default context updated with the given context, which must be a
+        dict owned by the caller (such as a **context argument), since it is returned
+        as is if there is no default context.
+        """
+        if not self.default_context:
+            return context
+        return {**self.default_context, **context}
 
-    def _find_closing_token(self, tag, tokens, pos):
+    def _cache_key(self, data, context):
         """
-        Given the current tag options, a list of tokens, and the current position
-        in the token list, this function will find the position of the closing token
-        associated with the specified tag. This may be a closing tag, a newline, or
-        simply the end of the list (to ensure tags are closed). This function should
-        return a tuple of the form (end_pos, consume), where consume should indicate
-        whether the ending token should be consumed or not.
+        Returns a key for caching the output of format(data, **context), or None if the
+        context can't be part of a key.
         """
-        embed_count = 0
-        block_count = 0
-        lt = len(tokens)
-        while pos < lt:
-            token_type, tag_name, tag_opts, token_text = tokens[pos]
-            if token_type == self.TOKEN_DATA:
-                # Short-circuit for performance.
-                pos += 1
-                continue
-            if tag.newline_closes and token_type in (
-                self.TOKEN_TAG_START,
-                self.TOKEN_TAG_END,
-            ):
-                # If we're finding the closing token for a tag that is closed by
-                # newlines, but there is an embedded tag that doesn't transform newlines
-                # (i.e. a code tag that keeps newlines intact), we need to skip over
-                # that.
-                inner_tag = self.recognized_tags[tag_name][1]
-                if not inner_tag.transform_newlines:
-                    if token_type == self.TOKEN_TAG_START:
-                        block_count += 1
-                    else:
-                        block_count -= 1
-            if (
-                token_type == self.TOKEN_NEWLINE
-                and tag.newline_closes
-                and block_count == 0
-            ):
-                # If for some crazy reason there are embedded tags that both close on
-                # newline, the first newline will automatically close all those nested
-                # tags.
-                return pos, True
-            elif token_type == self.TOKEN_TAG_START and tag_name == tag.tag_name:
-                if tag.same_tag_closes:
-                    return pos, False
-                if tag.render_embedded:
-                    embed_count += 1
-            elif token_type == self.TOKEN_TAG_END and tag_name == tag.tag_name:
-                if embed_count > 0:
-                    embed_count -= 1
-                else:
-                    return pos, True
-            pos += 1
-        return pos, True
+        key = self._context_key(self._full_context(context))
+        if key is None:
+            return None
+        fingerprint, items = key
+        return (fingerprint, data, items)
 
-    def _link_replace(self, match, **context):
+    def _context_key(self, full_context):
         """
-        Callback for re.sub to replace link text with markup. Turns out using a callback
-        function is actually faster than using backrefs, plus this lets us provide a
-        hook for user customization. linker_takes_context=True means that the linker
-        gets passed context like a standard format function.
+        Returns a tuple of render_fingerprint and the full context, or None if the
+        parser has no fingerprint or the context values aren't plain data (see
+        _plain_data). Objects such as requests may hash by identity, so they would
+        never be found in the cache, and only keep the objects alive.
         """
-        url = match.group(0)
-        if self.linker:
-            if self.linker_takes_context:
-                return self.linker(url, context)
-            else:
-                return self.linker(url)
-        else:
-            href = url
-            if "://" not in href:
-                href = "http://" + href
-            # Escape quotes to avoid XSS, let the browser escape the rest.
-            return self.url_template.format(href=href.replace('"', "%22"), text=url)
+        fingerprint = self.render_fingerprint()
+        if fingerprint is None:
+            return None
+        items = tuple(sorted(full_context.items()))
+        if not _plain_data(items):
+            return None
+        return (fingerprint, items)
+
+    def _format_batch(self, texts, context):
+        """
+        Formats a list of input texts for format_many, returning a list of outputs or
+        exceptions. The URLs in all of the texts are linked together, so the bulk_linker
+        is called once per batch. The deadline (if any) for each text covers tokenizing
+        and rendering it, but not the linking shared by the whole batch.
+        """
+        full_context = self._full_context(context)
+        results = [None] * len(texts)
+        documents = {}
+        # The time left before the deadline for each document after tokenizing it.
+        remaining = {}
+        cache_keys = {}
+        for idx, data in enumerate(texts):
+            try:
+                if self.cache is not None:
+                    key = self._cache_key(data, context)
+                    if key is not None:
+                        results[idx] = self.cache.get(key)
+                        if results[idx] is not None:
+                            continue
+                        cache_keys[idx] = key
+                expires = self._expires()
+                tokens = self._phase("tokenize", self._tokenize, data, True, expires)[0]
+                documents[idx] = Document(self, tokens)
+                if expires is not None:
+                    remaining[idx] = expires - time.perf_counter()
+            except _DeadlineExceeded:
+                results[idx] = self._plain_text(data)
+            except Exception as e:
+                results[idx] = e
+        try:
+            urls = [
+                url
+                for doc in documents.values()
+                for url in doc.links()[: self.max_links]
+            ]
+            link_markup = self._phase("link", self._link_markup, urls, full_context)
+        except Exception as e:
+            for idx in documents:
+                results[idx] = e
+            return results
+        for idx, doc in documents.items():
+            try:
+                expires = None
+                if idx in remaining:
+                    expires = time.perf_counter() + remaining[idx]
+                results[idx] = doc._render(full_context, link_markup, expires)
+                if idx in cache_keys:
+                    self.cache.set(cache_keys[idx], results[idx])
+            except _DeadlineExceeded:
+                results[idx] = self._plain_text(texts[idx])
+            except Exception as e:
+                results[idx] = e
+        return results
+
+    def format_compiled(self, blob, **context):
+        """
+        Formats a Document saved with Document.dumps, without parsing the text again
+        (unless the saved document is stale, see Parser.loads).
+        """
+        return self.loads(blob).render(**context)
 
-    def _transform(
-        self,
-        data,
-        escape_html,
-        replace_links,
-        replace_cosmetic,
-        transform_newlines,
-        **context,
+    def format_many(
+        self, iterable, workers=None, executor="process", chunksize=100, **context
     ):
         """
-        Transforms the input string based on the options specified, taking into account
-        whether the option is enabled globally for this parser.
+        Formats each input text from the given iterable, using a pool of worker
+        processes (executor="process") or threads (executor="thread"), or the calling
+        thread (executor=None). Results are yielded in input order, as soon as they are
+        available. If formatting an input raises an exception, the exception is yielded
+        in place of its output. Inputs are sent to the workers chunksize at a time, and
+        only a few chunks per worker are read from the iterable ahead of the results.
+        Any context keyword arguments are passed along as with format. If the parser
+        has a bulk_linker, it is called once per chunk.
         """
-        url_matches = {}
-        if self.replace_links and replace_links:
-            # If we're replacing links in the text (i.e. not those in [url] tags) then
-            # we need to be careful to pull them out before doing any escaping or
-            # cosmetic replacement.
-            pos = 0
-            while True:
-                match = _url_re.search(data, pos)
-                if not match:
-                    break
-                # Replace any link with a token that we can substitute back in after replacements.
-                token = "{{ bbcode-link-%s }}" % len(url_matches)
-                url_matches[token] = self._link_replace(match, **context)
-                start, end = match.span()
-                data = data[:start] + token + data[end:]
-                # To be perfectly accurate, this should probably be len(data[:start] + token), but
-                # start will work, because the token itself won't match as a URL.
-                pos = start
-        if escape_html:
-            data = self._replace(data, self.REPLACE_ESCAPE)
-        if replace_cosmetic:
-            data = self._replace(data, self.REPLACE_COSMETIC)
-        # Now put the replaced links back in the text.
-        for token, replacement in url_matches.items():
-            data = data.replace(token, replacement)
-        if transform_newlines:
-            data = data.replace("\n", "\r")
-        return data
+        chunks = _chunks(iterable, chunksize)
+        if executor is None:
+            for chunk in chunks:
+                yield from _format_chunk(chunk, context, self)
+            return
+        # Importing concurrent.futures is slow, so it's only done when a pool is used.
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        workers = workers or os.cpu_count() or 1
+        if executor == "process":
+            # The parser is sent to (or inherited by) each worker once, not per chunk.
+            pool = ProcessPoolExecutor(
+                workers, initializer=_init_format_worker, initargs=(self,)
+            )
+            parser = None
+        elif executor == "thread":
+            pool = ThreadPoolExecutor(workers)
+            parser = self
+        else:
+            raise ValueError("Unknown executor: %r" % executor)
+        with pool:
+            pending = deque(
+                pool.submit(_format_chunk, chunk, context, parser)
+                for chunk in itertools.islice(chunks, workers * 2)
+            )
+            while pending:
+                results = pending.popleft().result()
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(pool.submit(_format_chunk, chunk, context, parser))
+                yield from results
 
-    def _format_tokens(
-        self,
-        tokens,
-        parent,
-        escape_html=None,
-        replace_links=None,
-        replace_cosmetic=None,
-        transform_newlines=True,
-        depth=1,
-        **context,
-    ):
-        # Allow the parser defaults to be overridden when formatting.
-        escape_html = self.escape_html if escape_html is None else escape_html
-        replace_links = self.replace_links if replace_links is None else replace_links
-        replace_cosmetic = (
-            self.replace_cosmetic if replace_cosmetic is None else replace_cosmetic
-        )
+    def format_stream(self, reader, writer, chunk_size=65536, **context):
+        """
+        Formats text read from a file-like reader, writing the output to a file-like
+        writer as it goes. The text is read chunk_size characters at a time, and
+        everything up to the last newline outside of any tag is formatted and written
+        out, so only the text after it is kept in memory (or all of a top-level tag that
+        is still open). The output is the same as formatting the whole text at once, and
+        max_input_length, max_tokens and max_links limit the stream as a whole. Any
+        context keyword arguments are passed along as with format.
+        """
+        text = ""
+        # The characters left to read and the tokens left to render, if limited.
+        chars_left = self.max_input_length
+        tokens_left = self.max_tokens
+        # Counts the links rendered in all of the pieces.
+        link_limit = None
+        if self.max_links is not None:
+            link_limit = _LinkLimit(None, self.max_links)
+        # Set when a chunk ends with \r, which may be the start of a \r\n.
+        carriage_return = False
+        # The text is only tokenized again once it has doubled in size since the last
+        # time no place to split it was found, so a long top-level tag is not tokenized
+        # again for every chunk.
+        threshold = 0
+        while True:
+            if chars_left is None:
+                chunk = reader.read(chunk_size)
+            elif chars_left > 0:
+                chunk = reader.read(min(chunk_size, chars_left))
+            else:
+                chunk = ""
+                if reader.read(1):
+                    _observe_limit("max_input_length")
+            if not chunk:
+                break
+            if chars_left is not None:
+                chars_left -= len(chunk)
+            if carriage_return:
+                chunk = "\r" + chunk
+            carriage_return = chunk.endswith("\r")
+            if carriage_return:
+                chunk = chunk[:-1]
+            text += chunk.replace("\r\n", "\n").replace("\r", "\n")
+            if len(text) < threshold:
+                continue
+            # One token past the limit is kept, since the last token may be text that
+            # continues in the next chunk.
+            tokens, barrier = self._phase(
+                "tokenize",
+                self._tokenize,
+                text,
+                False,
+                None,
+                None if tokens_left is None else tokens_left + 1,
+            )
+            if tokens_left is not None and len(tokens) > tokens_left:
+                # The rest of the stream would be dropped, so the text read so far is
+                # formatted as the end of it.
+                break
+            closing = self._phase("pair", self._pair_tokens, tokens)
+            cut = self._stream_cut(tokens, closing, barrier)
+            if cut < 0:
+                threshold = len(text) * 2
+                continue
+            doc = Document(self, tokens[: cut + 1])
+            doc._closing = closing[: cut + 1]
+            writer.write(doc._render_within(context, link_limit))
+            # Valid tags can't contain newlines, so every newline in the text has its
+            # own newline token, and the cut is at the matching newline in the text.
+            pos = -1
+            for token in doc.tokens:
+                if token[0] == self.TOKEN_NEWLINE:
+                    pos = text.index("\n", pos + 1)
+            text = text[pos + 1 :]
+            threshold = len(text) * 2
+            if tokens_left is not None:
+                tokens_left -= len(doc.tokens)
+        if carriage_return:
+            text += "\n"
+        if text:
+            tokens = self._phase(
+                "tokenize", self._tokenize, text, True, None, tokens_left
+            )[0]
+            writer.write(Document(self, tokens)._render_within(context, link_limit))
+
+    def _stream_cut(self, tokens, closing, barrier):
+        """
+        Returns the index of the last newline token (at or after the barrier) that can
+        be used to split a partially read text, or -1 if there isn't one. Every start
+        tag before it must have been closed, so that the output of the tokens up to the
+        newline doesn't depend on the text that follows.
+        """
+        cut = -1
         idx = 0
-        formatted = []
-        lt = len(tokens)
-        while idx < lt:
+        count = len(tokens)
+        while idx < count:
             token_type, tag_name, tag_opts, token_text = tokens[idx]
             if token_type == self.TOKEN_TAG_START:
-                render_func, tag = self.recognized_tags[tag_name]
-                if tag.standalone:
-                    formatted.append(
-                        render_func(tag_name, None, tag_opts, parent, context)
-                    )
-                else:
-                    # First, find the extent of this tag's tokens.
-                    end, consume = self._find_closing_token(tag, tokens, idx + 1)
-                    subtokens = tokens[idx + 1 : end]
-                    # If the end tag should not be consumed, back up one (after grabbing the subtokens).
+                tag = self.recognized_tags[tag_name][1]
+                if not tag.standalone:
+                    end, consume = closing[idx]
+                    if end >= count:
+                        break
                     if not consume:
                         end = end - 1
-                    if tag.render_embedded and depth < self.max_tag_depth:
-                        # This tag renders embedded tags, simply recurse.
-                        inner = self._format_tokens(
-                            subtokens, tag, depth=depth + 1, **context
-                        )
-                    else:
-                        # Otherwise, just concatenate all the token text.
-                        inner = self._transform(
-                            "".join([t[3] for t in subtokens]),
-                            tag.escape_html,
-                            tag.replace_links,
-                            tag.replace_cosmetic,
-                            tag.transform_newlines,
-                            **context,
-                        )
-                    if tag.strip:
-                        inner = inner.strip()
-                    # Append the rendered contents.
-                    formatted.append(
-                        render_func(tag_name, inner, tag_opts, parent, context)
-                    )
-                    # If the tag should swallow the first trailing newline, check the token after the closing token.
                     if tag.swallow_trailing_newline:
-                        next_pos = end + 1
-                        if (
-                            next_pos < len(tokens)
-                            and tokens[next_pos][0] == self.TOKEN_NEWLINE
-                        ):
-                            end = next_pos
-                    # Skip to the end tag.
+                        if end + 1 >= count:
+                            break
+                        if tokens[end + 1][0] == self.TOKEN_NEWLINE:
+                            end = end + 1
                     idx = end
-            elif token_type == self.TOKEN_NEWLINE:
-                # If this is a top-level newline, replace it. Otherwise, it will be replaced (if necessary)
-                # by the code above.
-                formatted.append(
-                    "\r" if parent is None or parent.transform_newlines else token_text
-                )
-            elif token_type == self.TOKEN_DATA:
-                escape = escape_html if parent is None else parent.escape_html
-                links = replace_links if parent is None else parent.replace_links
-                cosmetic = (
-                    replace_cosmetic if parent is None else parent.replace_cosmetic
-                )
-                newlines = (
-                    transform_newlines if parent is None else parent.transform_newlines
-                )
-                formatted.append(
-                    self._transform(
-                        token_text, escape, links, cosmetic, newlines, **context
-                    )
-                )
+            # The text can be split after a top-level newline, or after a top-level tag
+            # that ends with a newline it was closed by or swallowed.
+            if tokens[idx][0] == self.TOKEN_NEWLINE and idx >= barrier:
+                cut = idx
             idx += 1
-        return "".join(formatted)
+        return cut
 
-    def format(self, data, **context):
+    def strip(self, data, strip_newlines=False):
         """
-        Formats the input text using any installed renderers. Any context keyword
+        Strips out any tags from the input text, using the same tokenization as the
+        formatter.
+        """
+        return self.parse(data).strip(strip_newlines=strip_newlines)
+
+
+# The keyword arguments of Parser that Parser.derive can override.
+_PARSER_OPTIONS = frozenset(
+    [
+        "newline",
+        "escape_html",
+        "replace_links",
+        "replace_cosmetic",
+        "tag_opener",
+        "tag_closer",
+        "linker",
+        "linker_takes_context",
+        "drop_unrecognized",
+        "default_context",
+        "max_tag_depth",
+        "url_template",
+        "cache",
+        "cosmetic_replacements",
+        "bulk_linker",
+        "link_cache",
+        "profile",
+        "max_input_length",
+        "max_tokens",
+        "max_links",
+        "deadline",
+    ]
+)
+# The options that affect Parser.parse_fingerprint, and those that affect neither
+# fingerprint.
+_PARSE_OPTIONS = frozenset(
+    ["tag_opener", "tag_closer", "drop_unrecognized", "max_input_length", "max_tokens"]
+)
+_UNFINGERPRINTED_OPTIONS = frozenset(
+    ["default_context", "cache", "link_cache", "profile", "deadline"]
+)
+
+
+class _FrozenDict(dict):
+    """
+    A dict that can't be changed after it is created, used by FrozenParser.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenTagOptions(TagOptions):
+    """
+    A copy of a TagOptions whose options can't be changed, used by FrozenParser.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, tag):
+        for attr in TagOptions.__slots__:
+            object.__setattr__(self, attr, getattr(tag, attr))
+
+    def __setattr__(self, attr, value):
+        raise TypeError(
+            "%s does not support attribute assignment" % type(self).__name__
+        )
+
+    def __reduce__(self):
+        options = {attr: getattr(self, attr) for attr in _TAG_OPTIONS}
+        return (type(self), (TagOptions(self.tag_name, **options),))
+
+
+class FrozenParser(Parser):
+    """
+    A Parser whose configuration can't be changed, returned by Parser.freeze. Its tag
+    table, tag options, default context and replacement tables are copied or compiled
+    up front, and its fingerprints are computed, so formatting never changes any
+    parser state (other than the render cache, which is thread-safe). Frozen parsers
+    can be pickled, and unpickle as frozen parsers.
+    """
+
+    def __init__(self, parser):
+        state = dict(vars(parser))
+        state["recognized_tags"] = {
+            name: (render_func, FrozenTagOptions(tag))
+            for name, (render_func, tag) in parser.recognized_tags.items()
+        }
+        state["_replacement_tables"] = {}
+        state["_fingerprints"] = {}
+        self._setup(state)
+
+    def _setup(self, state):
+        """
+        Installs the given parser state, compiling any replacement tables and computing
+        any fingerprints it is missing.
+        """
+        state["recognized_tags"] = _FrozenDict(state["recognized_tags"])
+        state["default_context"] = _FrozenDict(state["default_context"])
+        self.__dict__.update(state)
+        tables = dict(state["_replacement_tables"])
+        for flags in range(_REPLACEMENT_FLAGS + 1):
+            if flags & _REPLACEMENT_FLAGS == flags and flags not in tables:
+                tables[flags] = self._compile_replacement_table(flags)
+        self.__dict__["_replacement_tables"] = _FrozenDict(tables)
+        self.render_fingerprint()
+        self.__dict__["_fingerprints"] = _FrozenDict(self._fingerprints)
+
+    def _derived(self, state):
+        parser = type(self).__new__(type(self))
+        parser._setup(state)
+        return parser
+
+    def __setattr__(self, attr, value):
+        raise TypeError(
+            "%s does not support attribute assignment" % type(self).__name__
+        )
+
+    def __delattr__(self, attr):
+        raise TypeError("%s does not support attribute deletion" % type(self).__name__)
+
+    def add_formatter(self, tag_name, render_func, **kwargs):
+        raise TypeError("%s does not support adding formatters" % type(self).__name__)
+
+    def clear_cache(self):
+        """
+        Removes all entries from the render cache (if any). The fingerprints of a frozen
+        parser never change.
+        """
+        if self.cache is not None:
+            self.cache.clear()
+
+    def freeze(self):
+        """
+        Returns this parser, since it is already frozen.
+        """
+        return self
+
+
+class Document(object):
+    """
+    A parsed document, as returned by Parser.parse. The document is stored as the flat
+    list of tokens from Parser.tokenize, along with the closing token of each start tag
+    (found the first time they are needed). The tree of tags, text and newlines can be
+    walked using the children attribute.
+    """
+
+    __slots__ = ("parser", "tokens", "_closing")
+
+    # Incremented whenever the format written by Document.dumps changes.
+    SERIAL_VERSION = 1
+
+    def __init__(self, parser, tokens):
+        self.parser = parser
+        self.tokens = tokens
+        self._closing = None
+
+    @property
+    def closing(self):
+        if self._closing is None:
+            self._closing = self.parser._phase(
+                "pair", self.parser._pair_tokens, self.tokens
+            )
+        return self._closing
+
+    @property
+    def children(self):
+        """
+        The top-level nodes of the document.
+        """
+        return self._children(0, len(self.tokens))
+
+    def _children(self, start, stop):
+        """
+        Returns the nodes for the tokens between start and stop, skipping over the
+        contents and closing token of each tag (and any newline it swallows), the same
+        way the formatter does.
+        """
+        tokens = self.tokens
+        closing = self.closing
+        recognized_tags = self.parser.recognized_tags
+        nodes = []
+        idx = start
+        while idx < stop:
+            token_type, tag_name, tag_opts, token_text = tokens[idx]
+            if (
+                token_type != Parser.TOKEN_TAG_START
+                or recognized_tags[tag_name][1].standalone
+            ):
+                nodes.append(Node(self, idx, idx + 1))
+            else:
+                tag = recognized_tags[tag_name][1]
+                end, consume = closing[idx]
+                if end >= stop:
+                    end, consume = stop, True
+                nodes.append(Node(self, idx, end))
+                if not consume:
+                    end = end - 1
+                if (
+                    tag.swallow_trailing_newline
+                    and end + 1 < stop
+                    and tokens[end + 1][0] == Parser.TOKEN_NEWLINE
+                ):
+                    end = end + 1
+                idx = end
+            idx += 1
+        return nodes
+
+    def render(self, **context):
+        """
+        Formats the document using the parser's installed renderers. Any context keyword
         arguments given here will be passed along to the render functions as a context
         dictionary.
         """
-        tokens = self.tokenize(data)
-        full_context = self.default_context.copy()
-        full_context.update(context)
-        return self._format_tokens(tokens, None, **full_context).replace(
-            "\r", self.newline
-        )
+        return self._render_within(context)
 
-    def strip(self, data, strip_newlines=False):
+    def _render_within(self, context, link_limit=None):
         """
-        Strips out any tags from the input text, using the same tokenization as the
-        formatter.
+        Renders the document, or its text escaped as plain text if the parser's
+        deadline passes first. See _render for link_limit.
+        """
+        parser = self.parser
+        try:
+            return self._render_by(context, parser._expires(), link_limit)
+        except _DeadlineExceeded:
+            return parser._plain_text("".join([token[3] for token in self.tokens]))
+
+    def _render_by(self, context, expires, link_limit=None):
+        """
+        Renders the document, raising _DeadlineExceeded if expires (a
+        time.perf_counter value) passes first. See _render for link_limit.
+        """
+        parser = self.parser
+        full_context = parser._full_context(context)
+        link_markup = None
+        if parser.bulk_linker is not None or parser.link_cache is not None:
+            urls = self.links()
+            if link_limit is not None:
+                urls = urls[: max(link_limit.remaining, 0)]
+            elif parser.max_links is not None:
+                urls = urls[: parser.max_links]
+            link_markup = parser._phase("link", parser._link_markup, urls, full_context)
+        return self._render(full_context, link_markup, expires, link_limit)
+
+    def _render(self, context, link_markup, expires=None, link_limit=None):
+        """
+        Renders the document with the given link markup. If the parser has max_links,
+        the links are counted by link_limit (a _LinkLimit), which can be shared by the
+        parts of a longer text, or by a new _LinkLimit for this document.
+        """
+        if link_limit is not None:
+            link_limit.link_markup = link_markup
+            link_markup = link_limit
+        elif self.parser.max_links is not None:
+            link_markup = _LinkLimit(link_markup, self.parser.max_links)
+        return self.parser._format_tokens(
+            self.tokens, self.closing, link_markup, expires, **context
+        ).replace("\r", self.parser.newline)
+
+    def dumps(self):
+        """
+        Returns the parsed document as a compact JSON string, suitable for storing
+        alongside the source text and rendering later with Parser.format_compiled.
+        """
+        tokens = []
+        for token_type, tag_name, tag_opts, token_text in self.tokens:
+            if token_type == Parser.TOKEN_TAG_START:
+                opts = list(tag_opts.items()) if tag_opts else []
+                tokens.append((token_type, token_text, tag_name, opts))
+            elif token_type == Parser.TOKEN_TAG_END:
+                tokens.append((token_type, token_text, tag_name))
+            elif token_type == Parser.TOKEN_NEWLINE:
+                tokens.append((token_type,))
+            else:
+                tokens.append((token_type, token_text))
+        saved = {
+            "v": self.SERIAL_VERSION,
+            "fp": self.parser.parse_fingerprint(),
+            "t": tokens,
+            "c": self.closing,
+        }
+        return json.dumps(saved, ensure_ascii=False, separators=(",", ":"))
+
+    def strip(self, strip_newlines=False):
+        """
+        Returns the text of the document with any tags stripped out.
         """
         text = []
-        for token_type, tag_name, tag_opts, token_text in self.tokenize(data):
-            if token_type == self.TOKEN_DATA:
+        for token_type, tag_name, tag_opts, token_text in self.tokens:
+            if token_type == Parser.TOKEN_DATA:
                 text.append(token_text)
-            elif token_type == self.TOKEN_NEWLINE and not strip_newlines:
+            elif token_type == Parser.TOKEN_NEWLINE and not strip_newlines:
                 text.append(token_text)
         return "".join(text)
 
+    def links(self):
+        """
+        Returns a list of the URLs in the document that would be replaced with link
+        markup when rendered (not counting any link tags).
+        """
+        parser = self.parser
+        urls = []
+        if not parser.replace_links:
+            return urls
+        # Each entry is (iterator over nodes, parent TagOptions).
+        stack = [(iter(self.children), None)]
+        while stack:
+            nodes, parent = stack[-1]
+            node = next(nodes, None)
+            if node is None:
+                stack.pop()
+            elif node.type == Parser.TOKEN_DATA:
+                if parent is None or parent.replace_links:
+                    text = node.text
+                    urls.extend(text[start:end] for start, end in _find_urls(text))
+            elif node.type == Parser.TOKEN_TAG_START and not node.tag.standalone:
+                tag = node.tag
+                if tag.render_embedded and len(stack) < parser.max_tag_depth:
+                    stack.append((iter(node.children), tag))
+                elif tag.replace_links:
+                    text = "".join(
+                        [t[3] for t in self.tokens[node.index + 1 : node.stop]]
+                    )
+                    urls.extend(text[start:end] for start, end in _find_urls(text))
+        return urls
+
+
+class Node(object):
+    """
+    A node in a parsed Document: a tag along with its contents, a newline, or some text.
+    Nodes are views into the document's tokens, so they are cheap to create.
+    """
+
+    __slots__ = ("document", "index", "stop")
+
+    def __init__(self, document, index, stop):
+        self.document = document
+        # The index of this node's token, and the index just past its contents.
+        self.index = index
+        self.stop = stop
+
+    def __repr__(self):
+        return "<Node %r>" % self.text
+
+    @property
+    def type(self):
+        """
+        One of Parser.TOKEN_TAG_START, Parser.TOKEN_NEWLINE or Parser.TOKEN_DATA.
+        """
+        return self.document.tokens[self.index][0]
+
+    @property
+    def tag_name(self):
+        return self.document.tokens[self.index][1]
+
+    @property
+    def options(self):
+        return self.document.tokens[self.index][2]
+
+    @property
+    def text(self):
+        """
+        The original text of the token, i.e. the opening tag for tag nodes.
+        """
+        return self.document.tokens[self.index][3]
+
+    @property
+    def tag(self):
+        """
+        The TagOptions for tag nodes, otherwise None.
+        """
+        if self.type != Parser.TOKEN_TAG_START:
+            return None
+        return self.document.parser.recognized_tags[self.tag_name][1]
+
+    @property
+    def children(self):
+        if self.stop <= self.index + 1:
+            return []
+        return self.document._children(self.index + 1, self.stop)
+
+
+# The parser used by format_many in worker processes.
+_worker_parser = None
+
+
+def _init_format_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _format_chunk(chunk, context, parser=None):
+    """
+    Formats a list of input texts for Parser.format_many, returning a list of outputs
+    or exceptions.
+    """
+    parser = parser or _worker_parser
+    if parser.bulk_linker is not None:
+        return parser._format_batch(chunk, context)
+    results = []
+    for data in chunk:
+        try:
+            results.append(parser.format(data, **context))
+        except Exception as e:
+            results.append(e)
+    return results
+
 
 g_parser = None
+_g_parser_lock = threading.Lock()
+_g_metrics = None
+
+
+def set_metrics_registry(registry):
+    """
+    Installs a MetricsRegistry that every parser in this process reports to, or stops
+    collecting metrics if registry is None. Returns the previously installed registry.
+    """
+    global _g_metrics
+    previous, _g_metrics = _g_metrics, registry
+    return previous
+
+
+def _default_parser():
+    """
+    Returns the module-level default parser, creating it (once, even if several
+    threads get here at the same time) the first time it's needed.
+    """
+    global g_parser
+    if g_parser is None:
+        with _g_parser_lock:
+            if g_parser is None:
+                g_parser = Parser()
+    return g_parser
 
 
 def render_html(input_text, **context):
@@ -775,17 +3019,402 @@ def render_html(input_text, **context):
     A module-level convenience method that creates a default bbcode parser,
     and renders the input string as HTML.
     """
-    global g_parser
-    if g_parser is None:
-        g_parser = Parser()
-    return g_parser.format(input_text, **context)
+    return _default_parser().format(input_text, **context)
+
+
+_BENCH_WORDS = (
+    "the quick brown fox jumps over lazy dog forum post reply thread topic user "
+    "thanks everyone anyone know how to fix this problem with my setup"
+).split()
+
+_BENCH_MARKUP = (
+    "[b]%s[/b]",
+    "[i]%s[/i]",
+    "[u]%s[/u]",
+    "[color=red]%s[/color]",
+    "[url=http://example.com/%s]link[/url]",
+    "see http://www.example.com/page?id=%s for details",
+    "%s -- really... (c)",
+    "[quote=someone]%s[/quote]\n",
+    "[list]\n[*]%s\n[*]two\n[*]three\n[/list]\n",
+    "[code]for i in range(10):\n    print(%s)\n[/code]\n",
+)
+
+
+def _bench_corpus(count=200, seed=0):
+    """
+    Returns a list of count synthetic forum posts, with the usual mix of text, tags,
+    links, quotes, lists and code, for benchmarking.
+    """
+    rand = random.Random(seed)
+    posts = []
+    for _ in range(count):
+        lines = []
+        for _ in range(rand.randint(1, 8)):
+            words = [rand.choice(_BENCH_WORDS) for _ in range(rand.randint(5, 30))]
+            for _ in range(rand.randint(0, 3)):
+                pos = rand.randrange(len(words))
+                words[pos] = rand.choice(_BENCH_MARKUP) % words[pos]
+            lines.append(" ".join(words))
+        posts.append("\n".join(lines))
+    return posts
+
+
+def _bench_threads(parser, texts, max_threads, duration=1.0):
+    """
+    Formats the texts with a single parser shared by 1, 2, 4, ... up to max_threads
+    threads, each for about duration seconds, and returns a list of (threads, texts
+    formatted per second) tuples.
+    """
+    counts = []
+    threads = 1
+    while threads < max_threads:
+        counts.append(threads)
+        threads *= 2
+    counts.append(max_threads)
+    results = []
+    for threads in counts:
+        barrier = threading.Barrier(threads + 1)
+        done = [0] * threads
+
+        def work(num):
+            barrier.wait()
+            deadline = time.perf_counter() + duration
+            idx = num
+            while time.perf_counter() < deadline:
+                parser.format(texts[idx % len(texts)])
+                idx += threads
+                done[num] += 1
+
+        workers = [threading.Thread(target=work, args=(num,)) for num in range(threads)]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        results.append((threads, sum(done) / (time.perf_counter() - start)))
+    return results
+
+
+_BENCH_CORPORA = (
+    "posts",
+    "quotes",
+    "lists",
+    "urls",
+    "adversarial_urls",
+    "unclosed",
+    "code",
+)
+
+
+def _bench_corpora(scale=1.0):
+    """
+    Returns the synthetic corpora measured by `bbcode bench`, as a dict of corpus name
+    to list of texts: typical forum posts, deeply nested quotes, 1000-item lists, text
+    dense with URLs, long runs of URL characters (such as dots, slashes and
+    parentheses) that made the URL regex backtrack, unclosed tag openers, and large
+    code blocks. The sizes of the corpora are multiplied by scale.
+    """
+    rand = random.Random(0)
+
+    def size(num):
+        return max(1, int(num * scale))
 
+    def words(num):
+        return " ".join(rand.choice(_BENCH_WORDS) for _ in range(num))
 
-def main():
-    sys.stdout.write(render_html(sys.stdin.read()))
+    urls = (
+        "http://example.com/%s",
+        "https://www.example.org/%s?page=2&sort=new",
+        "www.example.net/%s.",
+        "(see example.co.uk/%s)",
+        "example.com/%s#top",
+    )
+    code_lines = (
+        "if (a < b && b > c) { return a; } // %s",
+        "x = y -- 1; /* (c) %s... */",
+        "print('<a href=\"http://example.com/%s\">')",
+    )
+    return {
+        "posts": _bench_corpus(size(200)),
+        "quotes": [
+            "".join("[quote=user%d]%s\n" % (num, words(5)) for num in range(size(500)))
+            + "[/quote]\n" * size(500)
+        ],
+        "lists": [
+            "[list]\n"
+            + "".join("[*]%s\n" % words(6) for _ in range(size(1000)))
+            + "[/list]\n"
+            for _ in range(3)
+        ],
+        "urls": [
+            " ".join(
+                (
+                    rand.choice(urls) % rand.choice(_BENCH_WORDS)
+                    if num % 2
+                    else rand.choice(_BENCH_WORDS)
+                )
+                for num in range(size(2000))
+            )
+        ],
+        "adversarial_urls": [
+            "http://" + "." * size(20000),
+            "a." * size(20000) + "com/",
+            "/" * size(40000),
+            "http://" + "(" * size(20000),
+            "http://x" + "(a" * size(10000) + ")" * size(10000),
+            "www." * size(10000),
+            "x.com/" * size(10000),
+        ],
+        "unclosed": [
+            "[" * size(20000),
+            "[b " * size(10000),
+            "[quote=" + " x [" * size(10000),
+        ],
+        "code": [
+            "[code]\n"
+            + "\n".join(
+                rand.choice(code_lines) % rand.choice(_BENCH_WORDS)
+                for _ in range(size(5000))
+            )
+            + "\n[/code]"
+        ],
+    }
+
+
+# The phases measured by `bbcode bench`: tokenizing, pairing start and end tags,
+# formatting the paired tokens, and all three together (Parser.format).
+_BENCH_PHASES = ("tokenize", "pair", "format", "total")
+
+
+def _bench_time(func, duration):
+    """
+    Calls func repeatedly for about duration seconds (and at least three times), and
+    returns the time taken by the fastest call, in seconds. Like timeit, this turns off
+    garbage collection while timing.
+    """
+    best = None
+    runs = 0
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        deadline = time.perf_counter() + duration
+        while runs < 3 or time.perf_counter() < deadline:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            runs += 1
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best
+
+
+def _bench_suite(parser, corpora, duration=0.25):
+    """
+    Times each phase of formatting each corpus (a dict of name to list of texts, as
+    returned by _bench_corpora), and returns a dict of corpus name to dict of phase
+    name to the time taken to process all of the texts in the corpus, in seconds.
+    """
+    results = {}
+    for name, texts in corpora.items():
+        tokens = [parser.tokenize(text) for text in texts]
+        closing = [parser._pair_tokens(toks) for toks in tokens]
+
+        def render():
+            for toks, close in zip(tokens, closing):
+                doc = Document(parser, toks)
+                doc._closing = close
+                doc.render()
+
+        results[name] = {
+            "tokenize": _bench_time(
+                lambda: [parser.tokenize(text) for text in texts], duration
+            ),
+            "pair": _bench_time(
+                lambda: [parser._pair_tokens(toks) for toks in tokens], duration
+            ),
+            "format": _bench_time(render, duration),
+            "total": _bench_time(
+                lambda: [parser.format(text) for text in texts], duration
+            ),
+        }
+    return results
+
+
+def _bench_compare(results, baseline, threshold=0.1):
+    """
+    Compares benchmark results with baseline results (both as returned by
+    _bench_suite). Returns a list of (corpus, phase, baseline time, time, change)
+    tuples for the phases measured in both, where change is the relative change in
+    time (0.1 is 10% slower), and the list of those that are more than threshold
+    slower.
+    """
+    changes = []
+    for name, phases in results.items():
+        for phase, elapsed in phases.items():
+            old = baseline.get(name, {}).get(phase)
+            if old:
+                changes.append((name, phase, old, elapsed, elapsed / old - 1))
+    regressions = [change for change in changes if change[4] > threshold]
+    return changes, regressions
+
+
+def _bench_threads_main(args):
+    parser = _default_parser().freeze()
+    texts = _bench_corpus()
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(
+        "Formatting %d posts, GIL %s" % (len(texts), "enabled" if gil else "disabled")
+    )
+    print("%8s %12s %8s %11s" % ("threads", "posts/sec", "speedup", "efficiency"))
+    base = None
+    duration = 1.0 if args.duration is None else args.duration
+    for threads, rate in _bench_threads(parser, texts, args.threads, duration):
+        base = base or rate
+        speedup = rate / base
+        print(
+            "%8d %12.0f %7.2fx %10.0f%%"
+            % (threads, rate, speedup, speedup / threads * 100)
+        )
+    return 0
+
+
+def _bench_main(args):
+    if args.threads is not None:
+        return _bench_threads_main(args)
+    corpora = {}
+    if args.corpus or not args.replay:
+        corpora = _bench_corpora(args.scale)
+        if args.corpus:
+            corpora = {name: corpora[name] for name in args.corpus}
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            corpora["replay"] = json.load(f)
+    duration = 0.25 if args.duration is None else args.duration
+    report = {
+        "version": __version__,
+        "python": "%s %s" % (sys.implementation.name, sys.version.split()[0]),
+        "results": _bench_suite(_default_parser().freeze(), corpora, duration),
+    }
+    changes = regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        changes, regressions = _bench_compare(
+            report["results"], baseline, args.threshold / 100
+        )
+        report["regressions"] = [
+            {"corpus": name, "phase": phase, "baseline": old, "time": new}
+            for name, phase, old, new, change in regressions
+        ]
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print("bbcode %s, %s" % (report["version"], report["python"]))
+        width = max([10] + [len(name) for name in report["results"]])
+        header = "%-*s %-10s %12s" % (width, "corpus", "phase", "ms")
+        if args.baseline:
+            header += " %12s %9s" % ("baseline ms", "change")
+        print(header)
+        compared = {
+            (name, phase): (old, change) for name, phase, old, new, change in changes
+        }
+        for name, phases in report["results"].items():
+            for phase, elapsed in phases.items():
+                line = "%-*s %-10s %12.3f" % (width, name, phase, elapsed * 1000)
+                if (name, phase) in compared:
+                    old, change = compared[name, phase]
+                    line += " %12.3f %+8.1f%%" % (old * 1000, change * 100)
+                print(line)
+        if regressions:
+            print(
+                "%d regression(s) of more than %g%%"
+                % (len(regressions), args.threshold)
+            )
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(
+        prog="bbcode", description="Renders BBCode from stdin to HTML on stdout."
+    )
+    arg_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="render the input as it is read, instead of reading it all first",
+    )
+    commands = arg_parser.add_subparsers(dest="command")
+    bench = commands.add_parser(
+        "bench",
+        help="time each phase of formatting the bundled corpora, or measure "
+        "formatting throughput with a shared parser",
+    )
+    bench.add_argument(
+        "--corpus",
+        action="append",
+        choices=_BENCH_CORPORA,
+        help="a corpus to measure (may be repeated; default: all of them)",
+    )
+    bench.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="measure the texts in a JSON list, such as slow inputs captured by a "
+        "MetricsRegistry, as the replay corpus (instead of the bundled corpora, unless "
+        "--corpus is given)",
+    )
+    bench.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="a factor to multiply the size of each corpus by (default: 1)",
+    )
+    bench.add_argument(
+        "--duration",
+        type=float,
+        help="seconds to measure each phase for (default: 0.25), or each number of "
+        "threads for (default: 1)",
+    )
+    bench.add_argument(
+        "--json", action="store_true", help="write the results as JSON to stdout"
+    )
+    bench.add_argument("--save", metavar="FILE", help="save the results as JSON")
+    bench.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="compare the results with ones saved by --save, and exit with status 1 "
+        "if any phase is slower by more than the threshold",
+    )
+    bench.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="the slowdown, in percent, counted as a regression (default: 10)",
+    )
+    bench.add_argument(
+        "--threads",
+        type=int,
+        nargs="?",
+        const=os.cpu_count() or 1,
+        help="instead, measure formatting throughput from 1 to THREADS threads "
+        "(default: CPU count)",
+    )
+    args = arg_parser.parse_args(argv)
+    if args.command == "bench":
+        return _bench_main(args)
+    if args.stream:
+        _default_parser().format_stream(sys.stdin, sys.stdout)
+    else:
+        sys.stdout.write(render_html(sys.stdin.read()))
     sys.stdout.write("\n")
     sys.stdout.flush()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
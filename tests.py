@@ -1,8 +1,147 @@
+import contextlib
+import gc
+import inspect
+import io
+import json
+import math
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import bbcode
 
 
+def _render_upper(tag_name, value, options, parent, context):
+    return value.upper()
+
+
+def _scaling_exponent(measure, make_input, sizes):
+    """
+    Measures the cost of an input of each of the given sizes, and returns the slope of
+    log(cost) against log(size), which is about 1 for linear and 2 for quadratic
+    growth.
+    """
+    points = []
+    for size in sizes:
+        cost = measure(make_input(size))
+        points.append((math.log(size), math.log(max(cost, 1e-9))))
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sum(
+        (x - mean_x) ** 2 for x, y in points
+    )
+
+
+class _CountingPattern(object):
+    """
+    Stands in for a compiled regex of bbcode for _work_counter, adding the number of
+    characters each search or match scans to counts[0]: from where it starts to the
+    end of what it found, or to the end of the text if a search finds nothing. The
+    backtracking inside a match isn't counted.
+    """
+
+    def __init__(self, pattern, counts):
+        self.pattern = pattern
+        self.counts = counts
+
+    def __getattr__(self, name):
+        return getattr(self.pattern, name)
+
+    def match(self, string, pos=0, endpos=sys.maxsize):
+        match = self.pattern.match(string, pos, endpos)
+        self.counts[0] += 1 + (match.end() - pos if match is not None else 0)
+        return match
+
+    def search(self, string, pos=0, endpos=sys.maxsize):
+        match = self.pattern.search(string, pos, endpos)
+        end = match.end() if match is not None else min(len(string), endpos)
+        self.counts[0] += 1 + max(end - pos, 0)
+        return match
+
+    def finditer(self, string, pos=0, endpos=sys.maxsize):
+        for match in self.pattern.finditer(string, pos, endpos):
+            self.counts[0] += 1 + match.end() - pos
+            pos = match.end()
+            yield match
+        self.counts[0] += 1 + max(min(len(string), endpos) - pos, 0)
+
+
+def _work_counter(func):
+    """
+    Returns a measure for _scaling_exponent: the number of lines of bbcode.py run by
+    func, plus the number of characters scanned by its regexes (see _CountingPattern).
+    Unlike the running time, this doesn't depend on the load of the machine.
+    """
+    filename = bbcode.__file__
+
+    def count_work(data):
+        counts = [0]
+
+        def trace_line(frame, event, arg):
+            if event == "line":
+                counts[0] += 1
+            return trace_line
+
+        def trace_call(frame, event, arg):
+            if frame.f_code.co_filename == filename:
+                return trace_line
+            return None
+
+        patched = {}
+        for name, value in vars(bbcode).items():
+            if isinstance(value, re.Pattern):
+                patched[name] = _CountingPattern(value, counts)
+            elif name == "_option_quoted_run_re":
+                patched[name] = {
+                    quote: _CountingPattern(pattern, counts)
+                    for quote, pattern in value.items()
+                }
+        tag_extent_re = bbcode._tag_extent_re
+        patched["_tag_extent_re"] = lambda opener, closer: _CountingPattern(
+            tag_extent_re(opener, closer), counts
+        )
+        originals = {name: getattr(bbcode, name) for name in patched}
+        previous = sys.gettrace()
+        vars(bbcode).update(patched)
+        sys.settrace(trace_call)
+        try:
+            func(data)
+        finally:
+            sys.settrace(previous)
+            vars(bbcode).update(originals)
+        return counts[0]
+
+    return count_work
+
+
+def _timer(func, repeat=3):
+    """
+    Returns a measure for _scaling_exponent: the fastest of repeat runs of func, in
+    seconds.
+    """
+
+    def time_runs(data):
+        best = None
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func(data)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            gc.enable()
+        return best
+
+    return time_runs
+
+
 class ParserTests(unittest.TestCase):
     TESTS = (
         ("[B]hello world[/b]", "<strong>hello world</strong>"),
@@ -100,6 +239,11 @@ class ParserTests(unittest.TestCase):
             'multiple <a rel="nofollow" href="http://apple.com/page">http://apple.com/page</a> '
             'link <a rel="nofollow" href="http://foo.com/foo--bar">http://foo.com/foo--bar</a> test',
         ),
+        (
+            "<a> www.apple.com -- {{ bbcode-link-0 }}",
+            '&lt;a&gt; <a rel="nofollow" href="http://www.apple.com">www.apple.com</a> '
+            "&ndash; {{ bbcode-link-0 }}",
+        ),
         (
             '[url=http://foo.com]<script>alert("XSS");</script>[/url]',
             '<a rel="nofollow" href="http://foo.com">&lt;script&gt;alert(&quot;XSS&quot;);&lt;/script&gt;</a>',
@@ -247,6 +391,16 @@ class ParserTests(unittest.TestCase):
         tag_name, opts = self.parser._parse_opts("quote=something author=other")
         self.assertEqual(tag_name, "quote")
         self.assertEqual(opts, {"quote": "something", "author": "other"})
+        # Options from identical tags are shared, so they can't be changed.
+        self.assertIs(self.parser._parse_opts("quote=something author=other")[1], opts)
+        with self.assertRaises(TypeError):
+            opts["Author"] = "someone"
+        self.assertEqual(opts.copy()["AUTHOR"], "other")
+        tag_name, opts = self.parser._parse_opts(
+            "list " + " ".join("a%d=%d" % (num, num) for num in range(5000))
+        )
+        self.assertEqual(len(opts), 5000)
+        self.assertEqual(opts["A4999"], "4999")
 
     def test_strip(self):
         result = self.parser.strip(
@@ -298,6 +452,29 @@ class ParserTests(unittest.TestCase):
         for line in self.URL_TESTS.splitlines():
             num = len(bbcode._url_re.findall(line))
             self.assertEqual(num, 1, 'Found %d links in "%s"' % (num, line.strip()))
+            spans = [m.span() for m in bbcode._url_re.finditer(line)]
+            self.assertEqual(list(bbcode._find_urls(line)), spans)
+
+    def test_adversarial_urls(self):
+        # Long runs of dots, slashes and parentheses used to make the URL regex
+        # backtrack for seconds (or hours). ComplexityTests and TimingTests check that
+        # they are formatted in linear time.
+        texts = [
+            "http://" + "." * 20000,
+            "a." * 20000,
+            "a." * 20000 + "com/",
+            "/" * 40000,
+            "http://" + "(" * 20000,
+            "http://x" + "(a" * 10000 + ")" * 10000,
+            "www." * 10000,
+            "x.com/" * 10000,
+        ]
+        for text in texts:
+            self.parser.format(text)
+            # Check against the regex on a shorter text, where it's fast enough.
+            short = text[:200]
+            spans = [m.span() for m in bbcode._url_re.finditer(short)]
+            self.assertEqual(list(bbcode._find_urls(short)), spans)
 
     def test_unicode(self):
         src = "[center]ƒünk¥ • §tüƒƒ[/center]"
@@ -339,3 +516,739 @@ class ParserTests(unittest.TestCase):
     def test_render_html(self):
         html = bbcode.render_html("[b]hello[/b] [i]world[/i]")
         self.assertEqual(html, "<strong>hello</strong> <em>world</em>")
+
+    def test_multichar_delimiters(self):
+        parser = bbcode.Parser(tag_opener="[[", tag_closer="]]")
+        self.assertEqual(
+            parser.format('[[b]]bold[[/b]] [[url="a]]b"]]link[[/url]] [b]'),
+            '<strong>bold</strong> <a rel="nofollow" href="a]]b">link</a> [b]',
+        )
+        self.assertEqual(parser.format("[[[b]]x[[/b]]"), "[<strong>x</strong>")
+
+    def test_unclosed_openers(self):
+        src = "[" * 5000 + '[b="' + "[i]" * 5000
+        tokens = self.parser.tokenize(src)
+        self.assertEqual("".join(t[3] for t in tokens), src)
+        self.assertTrue(all(t[0] == bbcode.Parser.TOKEN_DATA for t in tokens))
+
+    def test_pair_tokens(self):
+        tokens = self.parser.tokenize(
+            "[quote][b]x[quote]y[/quote][/b]\n[list][*]a\n[*]b[code]\n[/code]\n[/list]"
+        )
+        closing = self.parser._pair_tokens(tokens)
+        starts = [
+            (tokens[idx][1], closing[idx])
+            for idx in range(len(tokens))
+            if tokens[idx][0] == bbcode.Parser.TOKEN_TAG_START
+        ]
+        self.assertEqual(
+            starts,
+            [
+                ("quote", (len(tokens), True)),
+                ("b", (6, True)),
+                ("quote", (5, True)),
+                ("list", (18, True)),
+                ("*", (11, True)),
+                ("*", (17, True)),
+                ("code", (16, True)),
+            ],
+        )
+
+    def test_long_list(self):
+        src = "[list]" + "[*]item\n" * 500 + "[/list]"
+        self.assertEqual(
+            self.parser.format(src), "<ul>" + "<li>item</li>" * 500 + "</ul>"
+        )
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 2
+        parser = bbcode.Parser(max_tag_depth=depth + 1)
+        src = "[b]" * depth + "x" + "[/b]" * depth
+        self.assertEqual(
+            parser.format(src), "<strong>" * depth + "x" + "</strong>" * depth
+        )
+
+    def test_parse(self):
+        src = (
+            "[quote]see www.apple.com\n[b]bold[/b][/quote]\n[code]http://x.com/a[/code]"
+        )
+        doc = self.parser.parse(src)
+        self.assertEqual(doc.render(), self.parser.format(src))
+        self.assertEqual(doc.strip(), self.parser.strip(src))
+        self.assertEqual(doc.links(), ["www.apple.com", "http://x.com/a"])
+        quote, code = doc.children
+        self.assertEqual(quote.tag_name, "quote")
+        self.assertEqual(
+            [(node.type, node.text) for node in quote.children],
+            [
+                (bbcode.Parser.TOKEN_DATA, "see www.apple.com"),
+                (bbcode.Parser.TOKEN_NEWLINE, "\n"),
+                (bbcode.Parser.TOKEN_TAG_START, "[b]"),
+            ],
+        )
+        self.assertEqual(quote.children[2].children[0].text, "bold")
+        self.assertEqual(code.tag_name, "code")
+        self.assertEqual(self.parser.parse("[url]a.com/b[/url]").links(), [])
+
+    def test_format_compiled(self):
+        src = (
+            '[quote="Dan"]hello\n[b]world[/b] www.apple.com[/quote]\n[list][*]a[/list]'
+        )
+        blob = self.parser.parse(src).dumps()
+        self.assertEqual(self.parser.format_compiled(blob), self.parser.format(src))
+        doc = self.parser.loads(blob)
+        self.assertEqual(doc.tokens[0][2]["QUOTE"], "Dan")
+        # A parser that doesn't recognize the same tags parses the text again.
+        other = bbcode.Parser(install_defaults=False)
+        other.add_simple_formatter("b", "<b>%(value)s</b>")
+        self.assertNotEqual(other.parse_fingerprint(), self.parser.parse_fingerprint())
+        self.assertEqual(other.format_compiled(blob), other.format(src))
+
+    def test_render_cache(self):
+        cache = bbcode.RenderCache(max_entries=2)
+        parser = bbcode.Parser(cache=cache)
+        self.assertEqual(parser.format("[b]one[/b]"), "<strong>one</strong>")
+        self.assertEqual(parser.format("[b]one[/b]"), "<strong>one</strong>")
+        parser.format("[b]one[/b]", extra=1)
+        parser.format("[b]two[/b]")
+        # Context values that aren't plain data are not cached: lists can't be hashed,
+        # and other objects may hash by identity, so they would never be hit.
+        parser.format("[b]one[/b]", extra=[])
+        parser.format("[b]one[/b]", extra=object())
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 1, "misses": 3, "evictions": 1, "entries": 2, "size": 40},
+        )
+        parser.add_simple_formatter("b", "<b>%(value)s</b>")
+        self.assertEqual(parser.format("[b]two[/b]"), "<b>two</b>")
+        parser.clear_cache()
+        self.assertEqual(len(cache), 0)
+        # Callable objects are told apart by their attributes.
+
+        class Icon(object):
+            def __init__(self, path):
+                self.path = path
+
+            def __call__(self, tag_name, value, options, parent, context):
+                return '<img src="%s/%s">' % (self.path, value)
+
+        parsers = []
+        for path in ("/a", "/b"):
+            parser = bbcode.Parser(cache=cache)
+            parser.add_formatter("icon", Icon(path), render_embedded=False)
+            parsers.append(parser)
+        self.assertEqual(parsers[0].format("[icon]x[/icon]"), '<img src="/a/x">')
+        self.assertEqual(parsers[1].format("[icon]x[/icon]"), '<img src="/b/x">')
+        # Objects with attributes that aren't plain data can't be told apart, so the
+        # output isn't cached.
+        parser = bbcode.Parser(cache=cache)
+        parser.add_formatter("icon", Icon(object()), render_embedded=False)
+        self.assertIsNone(parser.render_fingerprint())
+        parser.clear_cache()
+        parser.format("[icon]x[/icon]")
+        self.assertEqual(len(cache), 0)
+        sized = bbcode.RenderCache(max_size=30)
+        parser = bbcode.Parser(cache=sized)
+        parser.format("[b]one[/b]")
+        parser.format("[b]two[/b]")
+        self.assertEqual(sized.stats()["entries"], 1)
+        self.assertEqual(sized.stats()["evictions"], 1)
+
+    def test_sqlite_render_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.db")
+            parser = bbcode.Parser(cache=bbcode.SQLiteRenderCache(path))
+            self.assertEqual(parser.format("[b]one[/b]"), "<strong>one</strong>")
+            # A new cache (i.e. in another process) sees the same entries.
+            cache = bbcode.SQLiteRenderCache(path, max_entries=2, check_interval=1)
+            parser = bbcode.Parser(cache=cache)
+            self.assertEqual(parser.format("[b]one[/b]"), "<strong>one</strong>")
+            self.assertEqual(cache.hits, 1)
+            parser.format("[b]two[/b]")
+            parser.format("[b]three[/b]")
+            self.assertEqual(
+                cache.stats(),
+                {"hits": 1, "misses": 2, "evictions": 1, "entries": 2, "size": 42},
+            )
+            parser.clear_cache()
+            self.assertEqual(len(cache), 0)
+            # Evicting by size keeps the most recently used entries that fit.
+            cache = bbcode.SQLiteRenderCache(path, max_size=30, check_interval=1)
+            for num in range(5):
+                cache.set(("key", num), "x" * 10)
+                time.sleep(0.001)
+            self.assertEqual(cache.evictions, 2)
+            self.assertEqual(cache.get(("key", 4)), "x" * 10)
+            self.assertIsNone(cache.get(("key", 1)))
+            # Context values that aren't plain data are never cached, since objects
+            # with the same repr would share an entry.
+            cache = bbcode.SQLiteRenderCache(os.path.join(tmpdir, "context.db"))
+            parser = bbcode.Parser(
+                cache=cache,
+                linker=lambda url, context: "%s:%s" % (context["request"].user, url),
+                linker_takes_context=True,
+            )
+
+            class Request(object):
+                def __init__(self, user):
+                    self.user = user
+
+                def __repr__(self):
+                    return "<Request>"
+
+            for user in ("alice", "bob"):
+                self.assertEqual(
+                    parser.format("www.x.com", request=Request(user)),
+                    "%s:www.x.com" % user,
+                )
+            self.assertEqual(len(cache), 0)
+
+    def test_import_without_sqlite(self):
+        code = "import sys; sys.modules['sqlite3'] = None; import bbcode; bbcode.render_html('x')"
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+
+    def test_format_many(self):
+        # The executors are only imported once a pool is used.
+        code = "import sys, bbcode; assert 'concurrent.futures' not in sys.modules"
+        subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+
+        def _render_fail(tag_name, value, options, parent, context):
+            raise ValueError(value)
+
+        self.parser.add_formatter("fail", _render_fail)
+        inputs = ["[b]%d[/b]" % num for num in range(250)] + ["[fail]x[/fail]"]
+        expected = ["<strong>%d</strong>" % num for num in range(250)]
+        for executor in (None, "thread", "process"):
+            results = list(
+                self.parser.format_many(
+                    inputs, workers=2, executor=executor, chunksize=16
+                )
+            )
+            self.assertEqual(results[:-1], expected)
+            self.assertIsInstance(results[-1], ValueError)
+        with self.assertRaises(ValueError):
+            list(self.parser.format_many(inputs, executor="fiber"))
+
+    def test_pickle(self):
+        parser = bbcode.Parser(
+            url_template='<a href="{href}">{text}</a>', cache=bbcode.RenderCache()
+        )
+        parser.add_simple_formatter("wiki", '<a href="/wiki/%(value)s">%(value)s</a>')
+        parser.add_formatter("upper", _render_upper, render_embedded=False)
+        src = (
+            "[url]apple.com[/url] [list][*]one[/list] [wiki]Foo[/wiki] [upper]x[/upper]"
+        )
+        parser.format(src)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for original in (parser, parser.freeze()):
+                copy = pickle.loads(pickle.dumps(original, protocol))
+                self.assertEqual(len(copy.cache), 0)
+                self.assertEqual(copy.format(src), parser.format(src))
+                self.assertEqual(copy.render_fingerprint(), parser.render_fingerprint())
+                tag = copy.recognized_tags["upper"][1]
+                self.assertEqual(tag.flags, parser.recognized_tags["upper"][1].flags)
+
+    def test_format_stream(self):
+        class Writer(list):
+            write = list.append
+
+        src = (
+            "[quote]one\r\n[*]two[/quote]\r\n[list]\n[*]a\n[*]b\n[/list]\n"
+            '[code]\n[b]x[/b]\n[/code]\nhttp://example.com [url="a\nb"]\n'
+        ) * 20 + "[b]unclosed\n[i"
+        expected = self.parser.format(src)
+        for chunk_size in (1, 7, 100000):
+            writer = Writer()
+            self.parser.format_stream(io.StringIO(src, newline=""), writer, chunk_size)
+            self.assertEqual("".join(writer), expected)
+            if chunk_size < len(src):
+                self.assertGreater(len(writer), 20)
+
+    def test_replacement_table(self):
+        table = bbcode.ReplacementTable(
+            [(":)", "A"), (":-)", "B"), ("<3", "C"), (":)", "D"), ("-", "E")]
+        )
+        self.assertEqual(table.replace(":-):)<3 - :-"), "BAC E :E")
+        smileys = [("smile%d" % num, "<%d>" % num) for num in range(100)]
+        # Entries are matched against the escaped text.
+        parser = bbcode.Parser(
+            cosmetic_replacements=smileys + [("&lt;3", "&hearts;"), ("<3", "X")]
+        )
+        self.assertEqual(
+            parser.format("smile1\nsmile10 <3 <b> [code]smile1 <3[/code]"),
+            "<1><br /><10> &hearts; &lt;b&gt; <code>smile1 &lt;3</code>",
+        )
+        self.assertEqual(parser.format("---"), "---")
+
+        class HeartParser(bbcode.Parser):
+            REPLACE_COSMETIC = bbcode.Parser.REPLACE_COSMETIC + (("&lt;3", "&hearts;"),)
+
+        self.assertEqual(HeartParser().format("I <3 you --"), "I &hearts; you &ndash;")
+        # Clearing the cache recompiles the tables after changing the replacements.
+        parser = bbcode.Parser()
+        self.assertEqual(parser.format("a -- b"), "a &ndash; b")
+        parser.cosmetic_replacements = bbcode.ReplacementTable([("b", "c")])
+        parser.clear_cache()
+        self.assertEqual(parser.format("a -- b"), "a -- c")
+
+    def test_bulk_linker(self):
+        calls = []
+
+        def bulk_linker(urls, context):
+            calls.append(urls)
+            return ['<a href="%s">%s</a>' % (url, context["text"]) for url in urls]
+
+        parser = bbcode.Parser(bulk_linker=bulk_linker, linker_takes_context=True)
+        src = "www.apple.com [b]http://example.com/[/b] [code]www.apple.com[/code]"
+        self.assertEqual(
+            parser.format(src, text="link"),
+            '<a href="www.apple.com">link</a> <strong><a href="http://example.com/">'
+            'link</a></strong> <code><a href="www.apple.com">link</a></code>',
+        )
+        self.assertEqual(calls, [["www.apple.com", "http://example.com/"]])
+        # Each batch of format_many links all of its URLs together.
+        del calls[:]
+        texts = ["www.apple.com", "[b]www.google.com[/b]", "www.apple.com"] * 3
+        results = list(parser.format_many(texts, executor=None, chunksize=6, text="x"))
+        self.assertEqual(results[:3], [parser.format(t, text="x") for t in texts[:3]])
+        self.assertEqual(calls[:2], [["www.apple.com", "www.google.com"]] * 2)
+        # Linker output can be memoized by URL and context.
+        del calls[:]
+        parser = bbcode.Parser(
+            bulk_linker=bulk_linker,
+            linker_takes_context=True,
+            link_cache=bbcode.RenderCache(),
+        )
+        parser.format("www.apple.com", text="a")
+        parser.format("www.apple.com www.google.com", text="a")
+        parser.format("www.apple.com", text="b")
+        self.assertEqual(
+            calls, [["www.apple.com"], ["www.google.com"], ["www.apple.com"]]
+        )
+        self.assertEqual(parser.link_cache.stats()["entries"], 3)
+        # A linker must return exactly one link per URL.
+        parser = bbcode.Parser(bulk_linker=lambda urls: urls[1:])
+        with self.assertRaises(ValueError):
+            parser.format("www.apple.com www.google.com")
+
+    def test_tag_options(self):
+        tag = bbcode.TagOptions("test", strip=True, escape_html=False)
+        self.assertTrue(tag.flags & bbcode.TagOptions.STRIP)
+        self.assertFalse(tag.flags & bbcode.TagOptions.ESCAPE_HTML)
+        self.assertTrue(tag.flags & bbcode.TagOptions.RENDER_EMBEDDED)
+        with self.assertRaises(AttributeError):
+            tag.unknown_option = True
+        # Changing an option updates the flags the formatter uses.
+        parser = bbcode.Parser()
+        parser.recognized_tags["b"][1].strip = True
+        self.assertEqual(parser.format("[b] bold [/b]"), "<strong>bold</strong>")
+        parser.recognized_tags["b"][1].strip = False
+        self.assertEqual(parser.format("[b] bold [/b]"), "<strong> bold </strong>")
+
+    def test_simple_formatter(self):
+        wiki = bbcode.SimpleFormatter('<a href="/%(value)s">%(value)s</a> 100%%')
+        self.assertEqual(wiki.parts, ['<a href="/', '">', "</a> 100%"])
+        self.assertEqual(
+            wiki("wiki", "Page", {}, None, {}), '<a href="/Page">Page</a> 100%'
+        )
+        font = bbcode.SimpleFormatter(
+            '<span style="font-size:%(size)dpx">%(value)s</span>'
+        )
+        self.assertEqual(font.parts, None)
+        self.assertEqual(font.keys, ("size",))
+        self.assertEqual(
+            font("font", "x", bbcode.CaseInsensitiveDict(SIZE=12), None, {}),
+            '<span style="font-size:12px">x</span>',
+        )
+        self.assertEqual(bbcode.SimpleFormatter("%s").keys, None)
+        parser = bbcode.Parser()
+        parser.add_simple_formatter("wiki", '<a href="/%(value)s">%(value)s</a>')
+        parser.add_simple_formatter("font", "<font size=%(size)s>%(value)s</font>")
+        self.assertEqual(
+            parser.format("[wiki]a[/wiki] [font size=2][wiki]b[/wiki][/font]"),
+            '<a href="/a">a</a> <font size=2><a href="/b">b</a></font>',
+        )
+
+    def test_freeze(self):
+        parser = bbcode.Parser(default_context={"user": "me"})
+        parser.add_simple_formatter("wiki", '<a href="/%(value)s">%(value)s</a>')
+        frozen = parser.freeze()
+        self.assertIsInstance(frozen, bbcode.FrozenParser)
+        self.assertIs(frozen.freeze(), frozen)
+        self.assertEqual(frozen.render_fingerprint(), parser.render_fingerprint())
+        src = "[b]bold[/b] [wiki]Page[/wiki] -- www.apple.com\n[code]x[/code]"
+        self.assertEqual(frozen.format(src), parser.format(src))
+        with self.assertRaises(TypeError):
+            frozen.add_simple_formatter("u", "<u>%(value)s</u>")
+        with self.assertRaises(TypeError):
+            frozen.newline = "\n"
+        with self.assertRaises(TypeError):
+            frozen.recognized_tags["b"][1].strip = True
+        with self.assertRaises(TypeError):
+            del frozen.recognized_tags["b"]
+        with self.assertRaises(TypeError):
+            frozen.default_context["user"] = "you"
+        # Changes to the original parser don't affect the frozen copy.
+        parser.add_simple_formatter("b", "<b>%(value)s</b>")
+        self.assertEqual(frozen.format("[b]x[/b]"), "<strong>x</strong>")
+        clone = pickle.loads(pickle.dumps(frozen))
+        self.assertIsInstance(clone, bbcode.FrozenParser)
+        self.assertEqual(clone.format(src), frozen.format(src))
+        results = list(frozen.format_many([src] * 20, workers=4, executor="thread"))
+        self.assertEqual(results, [frozen.format(src)] * 20)
+
+    def test_derive(self):
+        self.assertEqual(
+            bbcode._PARSER_OPTIONS,
+            set(inspect.signature(bbcode.Parser).parameters) - {"install_defaults"},
+        )
+        parser = bbcode.Parser(cache=bbcode.RenderCache())
+        src = "[b]bold[/b] [i]it[/i] [u]under[/u]\n--"
+        derived = parser.derive(tags_enabled=["B", "i"], newline="\n")
+        self.assertIs(derived.cache, parser.cache)
+        self.assertEqual(
+            derived.format(src),
+            "<strong>bold</strong> <em>it</em> [u]under[/u]\n&ndash;",
+        )
+        self.assertNotEqual(derived.render_fingerprint(), parser.render_fingerprint())
+        self.assertIn("<u>", parser.format(src))
+        derived = parser.derive(tags_disabled=["i"], replace_cosmetic=False)
+        self.assertEqual(
+            derived.format(src), "<strong>bold</strong> [i]it[/i] <u>under</u><br />--"
+        )
+        tenant = parser.derive(default_context={"tenant": 1})
+        self.assertEqual(tenant.render_fingerprint(), parser.render_fingerprint())
+        self.assertEqual(tenant.default_context, {"tenant": 1})
+        self.assertEqual(parser.default_context, {})
+        tables = parser.derive(cosmetic_replacements=[(":)", "<smile>")])
+        self.assertEqual(tables.format(":) --"), "<smile> --")
+        self.assertEqual(parser.format(":) --"), ":) &ndash;")
+        # Installing formatters on a derived parser doesn't change the base parser.
+        tenant.add_simple_formatter("b", "<b>%(value)s</b>")
+        self.assertEqual(tenant.format("[b]x[/b]"), "<b>x</b>")
+        self.assertEqual(parser.format("[b]x[/b]"), "<strong>x</strong>")
+        with self.assertRaises(TypeError):
+            parser.derive(install_defaults=False)
+        frozen = parser.freeze().derive(tags_disabled=["b"], escape_html=False)
+        self.assertIsInstance(frozen, bbcode.FrozenParser)
+        self.assertEqual(frozen.format("[b]<x>[/b]"), "[b]<x>[/b]")
+        with self.assertRaises(TypeError):
+            frozen.recognized_tags["i"] = parser.recognized_tags["i"]
+
+    def test_threads(self):
+        parser = bbcode.Parser(default_context={"user": "me"})
+        texts = bbcode._bench_corpus(50)
+        expected = [parser.format(text) for text in texts]
+        errors = []
+
+        def work():
+            try:
+                for _ in range(5):
+                    if [parser.format(text) for text in texts] != expected:
+                        errors.append("output changed")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # Installing formatters for other tags doesn't disturb formatting.
+        for num in range(200):
+            parser.add_simple_formatter("tag%d" % num, "<t>%(value)s</t>")
+            parser.render_fingerprint()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(parser.format("[tag9]x[/tag9]"), "<t>x</t>")
+        rates = bbcode._bench_threads(parser.freeze(), texts, 3, duration=0.01)
+        self.assertEqual([threads for threads, rate in rates], [1, 2, 3])
+
+    def test_profile(self):
+        calls = []
+        parser = bbcode.Parser(profile=lambda *args: calls.append(args))
+        parser.add_simple_formatter("wiki", "<i>%(value)s</i>")
+        src = "[quote][wiki]x[/wiki] [b]y[/b][/quote][hr] www.apple.com"
+        expected = "<blockquote><i>x</i> <strong>y</strong></blockquote><hr /> "
+        self.assertTrue(parser.format(src).startswith(expected))
+        phases = [(phase, name) for phase, name, elapsed in calls]
+        self.assertEqual(phases[:2], [("tokenize", None), ("pair", None)])
+        self.assertEqual(phases[-1], ("format", None))
+        for tag_name in ("quote", "wiki", "b", "hr"):
+            self.assertEqual(phases.count(("render", tag_name)), 1)
+        self.assertEqual(phases.count(("transform", None)), 4)
+        self.assertTrue(all(elapsed >= 0 for phase, name, elapsed in calls))
+        stats = bbcode.ProfileStats()
+        parser = bbcode.Parser(profile=stats, bulk_linker=lambda urls: urls)
+        for _ in range(3):
+            parser.format(src)
+        self.assertEqual(stats.stats()[("render", "b")][0], 3)
+        self.assertEqual(stats.stats()[("link", None)][0], 3)
+        self.assertIn("render", stats.report())
+        clone = pickle.loads(pickle.dumps(bbcode.Parser(profile=stats)))
+        self.assertEqual(clone.profile.stats(), {})
+        stats.clear()
+        self.assertEqual(stats.stats(), {})
+
+    def test_metrics(self):
+        registry = bbcode.MetricsRegistry(slow_threshold=0, slow_inputs=2)
+        self.assertIsNone(bbcode.set_metrics_registry(registry))
+        try:
+            parser = bbcode.Parser(cache=bbcode.RenderCache())
+            for src in ("[b]x[/b] [foo]y[/foo]", "[b]x[/b] [foo]y[/foo]", "[i]z[/i]"):
+                parser.format(src)
+            bbcode.Parser(drop_unrecognized=True).format("[foo]y[/foo]")
+        finally:
+            self.assertIs(bbcode.set_metrics_registry(None), registry)
+        bbcode.Parser().format("not counted")
+        stats = registry.stats()
+        self.assertEqual(stats["formats"], 4)
+        self.assertEqual(stats["input_chars"], 21 + 21 + 8 + 12)
+        self.assertEqual(stats["tokens"], 7 + 3 + 1)
+        self.assertEqual((stats["cache_hits"], stats["cache_misses"]), (1, 2))
+        self.assertEqual((stats["unrecognized_tags"], stats["dropped_tags"]), (2, 2))
+        self.assertEqual(stats["slow_inputs"], 4)
+        self.assertEqual(
+            [text for seconds, text in registry.slow_inputs()],
+            ["[i]z[/i]", "[foo]y[/foo]"],
+        )
+        text = registry.exposition()
+        self.assertIn('bbcode_format_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn('bbcode_tokens_bucket{le="8"} 3\n', text)
+        self.assertIn("bbcode_cache_hits_total 1\n", text)
+        self.assertIn("# TYPE bbcode_dropped_tags_total counter\n", text)
+        registry.reset()
+        self.assertEqual(registry.stats()["formats"], 0)
+        self.assertEqual(registry.slow_inputs(), [])
+
+    def test_limits(self):
+        src = "[b]hello [i]world and more[/i][/b] tail"
+        parser = bbcode.Parser(max_input_length=20)
+        self.assertEqual(parser.format(src), "<strong>hello <em>world an</em></strong>")
+        parser = bbcode.Parser(max_tokens=4)
+        self.assertEqual(
+            parser.format(src), "<strong>hello <em>world and more</em></strong>"
+        )
+        self.assertEqual(len(parser.tokenize(src)), 4)
+        self.assertNotEqual(
+            parser.parse_fingerprint(), bbcode.Parser().parse_fingerprint()
+        )
+        src = "http://a.com www.b.com <http://c.com> http://a.com"
+        parser = bbcode.Parser(max_links=2)
+        self.assertEqual(
+            parser.format(src),
+            '<a rel="nofollow" href="http://a.com">http://a.com</a> '
+            '<a rel="nofollow" href="http://www.b.com">www.b.com</a> '
+            "&lt;http://c.com&gt; http://a.com",
+        )
+        linked = []
+
+        def bulk_linker(urls):
+            linked.extend(urls)
+            return ["<%s>" % url for url in urls]
+
+        parser = bbcode.Parser(max_links=1, bulk_linker=bulk_linker)
+        self.assertEqual(
+            parser.format(src),
+            "<http://a.com> www.b.com &lt;http://c.com&gt; http://a.com",
+        )
+        self.assertEqual(linked, ["http://a.com"])
+        del linked[:]
+        texts = [src, "http://d.com http://e.com"]
+        self.assertEqual(
+            list(parser.format_many(texts, executor=None)),
+            [parser.format(text) for text in texts],
+        )
+        self.assertEqual(linked[:2], ["http://a.com", "http://d.com"])
+        # The limits apply to a stream as a whole.
+        src = "[b]hello[/b] [i]world[/i] www.x%d.com\n" * 100 % tuple(range(100))
+        for parser in (
+            bbcode.Parser(max_input_length=100),
+            bbcode.Parser(max_tokens=10),
+            bbcode.Parser(max_input_length=500, max_tokens=60),
+            bbcode.Parser(max_links=2),
+            bbcode.Parser(max_links=3, bulk_linker=bulk_linker),
+        ):
+            for chunk_size in (1, 7, 64):
+                output = io.StringIO()
+                parser.format_stream(io.StringIO(src), output, chunk_size=chunk_size)
+                self.assertEqual(output.getvalue(), parser.format(src))
+        # Past the deadline, the text is rendered as escaped plain text, and not cached.
+        src = "[b]x<y[/b]\n" * 1000
+        parser = bbcode.Parser(deadline=0, cache=bbcode.RenderCache())
+        self.assertEqual(parser.format(src), "[b]x&lt;y[/b]<br />" * 1000)
+        self.assertEqual(len(parser.cache), 0)
+        self.assertEqual(parser.parse(src).render(), "[b]x&lt;y[/b]<br />" * 1000)
+        self.assertEqual(
+            list(parser.format_many([src], executor=None)), [parser.format(src)]
+        )
+        parser = bbcode.Parser(deadline=60, cache=bbcode.RenderCache())
+        self.assertEqual(parser.format(src), bbcode.Parser().format(src))
+        self.assertEqual(len(parser.cache), 1)
+        registry = bbcode.MetricsRegistry()
+        bbcode.set_metrics_registry(registry)
+        try:
+            bbcode.Parser(deadline=0, max_links=0).format(src + "www.apple.com")
+            bbcode.Parser(max_tokens=1).format(src)
+        finally:
+            bbcode.set_metrics_registry(None)
+        self.assertEqual(
+            registry.stats()["limits_exceeded"], {"deadline": 1, "max_tokens": 1}
+        )
+        self.assertIn(
+            'bbcode_limits_exceeded_total{limit="deadline"} 1', registry.exposition()
+        )
+
+    def test_bench(self):
+        corpora = bbcode._bench_corpora(0.01)
+        self.assertEqual(tuple(corpora), bbcode._BENCH_CORPORA)
+        results = bbcode._bench_suite(bbcode.Parser(), corpora, duration=0)
+        for name in bbcode._BENCH_CORPORA:
+            self.assertEqual(tuple(results[name]), bbcode._BENCH_PHASES)
+        baseline = {"posts": {"tokenize": 1.0, "format": 1.0}, "gone": {"pair": 1.0}}
+        results = {"posts": {"tokenize": 1.05, "format": 1.5, "pair": 1.0}}
+        changes, regressions = bbcode._bench_compare(results, baseline, 0.1)
+        self.assertEqual(
+            [change[:2] for change in changes],
+            [("posts", "tokenize"), ("posts", "format")],
+        )
+        self.assertEqual(
+            [change[:4] for change in regressions], [("posts", "format", 1.0, 1.5)]
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "baseline.json")
+            args = ["bench", "--corpus", "urls", "--scale", "0.01", "--duration", "0"]
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(bbcode.main(args + ["--json", "--save", path]), 0)
+            report = json.loads(out.getvalue())
+            self.assertEqual(list(report["results"]), ["urls"])
+            replay_path = os.path.join(tmpdir, "replay.json")
+            with open(replay_path, "w", encoding="utf-8") as f:
+                json.dump(["[b]slow[/b]"], f)
+            replay = ["bench", "--replay", replay_path, "--duration", "0", "--json"]
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(bbcode.main(replay), 0)
+            self.assertEqual(list(json.loads(out.getvalue())["results"]), ["replay"])
+            with open(path, encoding="utf-8") as f:
+                self.assertEqual(json.load(f), report)
+            # Make the baseline impossibly fast, so everything is a regression.
+            for phase in report["results"]["urls"]:
+                report["results"]["urls"][phase] = 1e-12
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                self.assertEqual(bbcode.main(args + ["--baseline", path]), 1)
+            self.assertIn("4 regression(s) of more than 10%", out.getvalue())
+
+
+class ComplexityTests(unittest.TestCase):
+    """
+    Checks that the hot paths scale linearly on families of adversarial inputs, by
+    counting the work done (see _work_counter) on inputs of doubling sizes. Backtracking
+    inside the regexes isn't counted, so TimingTests times the same families (and the
+    regexes on their own) when the BBCODE_TIMING_TESTS environment variable is set.
+    """
+
+    # The counts are exact, and fixed costs only bring the exponent of linear code a
+    # little under 1; quadratic growth has an exponent of 2.
+    MAX_EXPONENT = 1.1
+
+    def setUp(self):
+        self.parser = bbcode.Parser()
+
+    def measure(self, func):
+        return _work_counter(func)
+
+    def assertLinear(self, func, families, base):
+        sizes = [base * 2**num for num in range(5)]
+        for name, make_input in families.items():
+            exponent = _scaling_exponent(self.measure(func), make_input, sizes)
+            if exponent >= self.MAX_EXPONENT:
+                self.fail("%s grows with exponent %.2f" % (name, exponent))
+
+    def test_tag_extent(self):
+        # Tokenizing finds the extent of every opener in turn.
+        families = {
+            "openers": lambda n: "[" * n,
+            "unclosed quotes": lambda n: '[b="' * n,
+            "unclosed options": lambda n: "[a=" * n + "]",
+        }
+        self.assertLinear(self.parser.tokenize, families, 500)
+
+    def test_pair_tokens(self):
+        tokenize = self.parser.tokenize
+        families = {
+            "nested": lambda n: tokenize("[quote]" * n + "x" + "[/quote]" * n),
+            "unclosed": lambda n: tokenize("[b][i]" * n),
+            "misclosed": lambda n: tokenize("[b]" * n + "[/i]" * n),
+            "list items": lambda n: tokenize("[list]" + "[*]x\n" * n),
+            "stray closers": lambda n: tokenize("[quote]" + "[/b]" * n),
+        }
+        self.assertLinear(self.parser._pair_tokens, families, 500)
+
+    def test_transform_urls(self):
+        flags = bbcode.TagOptions.REPLACE_LINKS | bbcode.TagOptions.ESCAPE_HTML
+        families = {
+            "dots": lambda n: "a." * n,
+            "slashes": lambda n: "/" * n,
+            "parentheses": lambda n: "http://x" + "(a" * n + ")" * n,
+            "www": lambda n: "www." * n,
+            "hosts": lambda n: "x.com/" * n,
+            "scheme and dots": lambda n: "http://" + "." * n,
+            "scheme and parentheses": lambda n: "http://" + "(" * n,
+            "dots and a host": lambda n: "a." * n + "com/",
+        }
+        transform = self.parser._transform
+        self.assertLinear(lambda data: transform(data, flags, None, {}), families, 2000)
+
+    def test_parse_tag_options(self):
+        families = {
+            "equals signs": lambda n: "a" + "=" * n,
+            "many options": lambda n: "a " + "b=c " * n,
+            "escaped quotes": lambda n: 'a="' + '\\"' * n,
+            "unterminated quotes": lambda n: "a " + "b='" * n,
+        }
+        self.assertLinear(bbcode._parse_tag_options, families, 500)
+
+
+@unittest.skipUnless(
+    os.environ.get("BBCODE_TIMING_TESTS"), "set BBCODE_TIMING_TESTS=1 to run"
+)
+class TimingTests(ComplexityTests):
+    """
+    Runs the complexity tests with timings instead of counts of the work done, which
+    also covers backtracking inside the regexes. Timings depend on the load of the machine, so these only run when the
+    BBCODE_TIMING_TESTS environment variable is set.
+    """
+
+    # Timings are noisy, so this is generous.
+    MAX_EXPONENT = 1.4
+
+    def measure(self, func):
+        return _timer(func)
+
+    def assertLinear(self, func, families, base):
+        # Try again before failing, in case something else was running.
+        try:
+            super().assertLinear(func, families, base)
+        except AssertionError:
+            super().assertLinear(func, families, base)
+
+    def test_tag_extent_regex(self):
+        tag_extent = bbcode._tag_extent_re("[", "]").match
+        families = {
+            "closers in quotes": lambda n: '[a="' + "]x" * n,
+            "equals signs": lambda n: "[a" + "=" * n,
+            "alternating quotes": lambda n: "[a=" + "'\"" * n,
+        }
+        self.assertLinear(lambda data: tag_extent(data, 1), families, 20000)
+        tag_extent = bbcode._tag_extent_re("[[", "]]").match
+        families = {"partial delimiters": lambda n: "[[a" + "[]" * n}
+        self.assertLinear(lambda data: tag_extent(data, 2), families, 2000)